@@ -0,0 +1,249 @@
+import argparse
+import binascii
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+from chunked import build_cubes_chunked
+from helper import *
+from loader import count_rows, get_source_path, read_csv
+from profiling import get_rss
+
+# Shape of the generated data, taken from the shipped sample: about 20 encounters per patient and 2 procedures per encounter
+ENCOUNTERS_PER_PATIENT = 20
+PROCEDURES_PER_ENCOUNTER = 2
+ENCOUNTER_CLASSES = {'ambulatory': 0.3, 'outpatient': 0.2, 'inpatient': 0.2, 'wellness': 0.1, 'urgentcare': 0.1, 'emergency': 0.1}
+PAYER_NAMES = ['Dual Eligible', 'Medicare', 'Medicaid', 'Humana', 'Blue Cross Blue Shield', 'UnitedHealthcare', 'Aetna', 'Cigna Health', 'Anthem', 'NO_INSURANCE']
+N_PROCEDURE_TYPES = 40
+START_DATE = np.datetime64('2011-01-01T00:00:00')
+STOP_DATE = np.datetime64('2022-02-01T00:00:00')
+
+ENCOUNTERS_HEADER = ['Id', 'START', 'STOP', 'PATIENT', 'ORGANIZATION', 'PAYER', 'ENCOUNTERCLASS', 'CODE', 'DESCRIPTION', 'BASE_ENCOUNTER_COST', 'TOTAL_CLAIM_COST', 'PAYER_COVERAGE', 'REASONCODE', 'REASONDESCRIPTION']
+PROCEDURES_HEADER = ['START', 'STOP', 'PATIENT', 'ENCOUNTER', 'CODE', 'DESCRIPTION', 'BASE_COST', 'REASONCODE', 'REASONDESCRIPTION']
+PATIENTS_HEADER = ['Id', 'BIRTHDATE', 'DEATHDATE', 'PREFIX', 'FIRST', 'LAST', 'SUFFIX', 'MAIDEN', 'MARITAL', 'RACE', 'ETHNICITY', 'GENDER', 'BIRTHPLACE', 'ADDRESS', 'CITY', 'STATE', 'COUNTY', 'ZIP', 'LAT', 'LON']
+PAYERS_HEADER = ['Id', 'NAME', 'ADDRESS', 'CITY', 'STATE_HEADQUARTERED', 'ZIP', 'PHONE']
+ORGANIZATIONS_HEADER = ['Id', 'NAME', 'ADDRESS', 'CITY', 'STATE', 'ZIP', 'LAT', 'LON']
+
+def make_ids(rng, n):
+    # Random UUID-formatted keys built as one byte array rather than one Python string at a time
+    hexed = np.frombuffer(binascii.hexlify(rng.bytes(16 * n)), dtype=np.uint8).reshape(n, 32)
+    ids = np.full((n, 36), ord('-'), dtype=np.uint8)
+    ids[:, [i for i in range(36) if i not in (8, 13, 18, 23)]] = hexed
+
+    return ids.view('S36').ravel().astype(str)
+
+def format_times(times):
+    return np.char.add(np.datetime_as_string(times.astype('datetime64[s]'), unit='s'), 'Z')
+
+def write_table(df, path, header):
+    df.reindex(columns=header).to_csv(path, index=False, mode='a' if os.path.exists(path) else 'w', header=not os.path.exists(path))
+
+def generate_data(n_encounters, data_dir, seed=0, chunk_size=1_000_000):
+    # Tables follow data/data_dictionary.csv, and encounters are written in START order one chunk of time at a time
+    rng = np.random.default_rng(seed)
+    os.makedirs(data_dir, exist_ok=True)
+    for table in ['encounters', 'procedures', 'patients', 'payers', 'organizations']:
+        if os.path.exists(os.path.join(data_dir, f'{table}.csv')):
+            os.remove(os.path.join(data_dir, f'{table}.csv'))
+
+    organization_id = make_ids(rng, 1)[0]
+    write_table(pd.DataFrame({'Id': [organization_id], 'NAME': ['MASSACHUSETTS GENERAL HOSPITAL'], 'CITY': ['BOSTON'], 'STATE': ['MA']}), os.path.join(data_dir, 'organizations.csv'), ORGANIZATIONS_HEADER)
+
+    payer_ids = make_ids(rng, len(PAYER_NAMES))
+    write_table(pd.DataFrame({'Id': payer_ids, 'NAME': PAYER_NAMES}), os.path.join(data_dir, 'payers.csv'), PAYERS_HEADER)
+
+    n_patients = max(1, n_encounters // ENCOUNTERS_PER_PATIENT)
+    patient_ids = make_ids(rng, n_patients)
+    birthdates = START_DATE.astype('datetime64[D]') - rng.integers(0, 90 * 365, n_patients).astype('timedelta64[D]')
+    for offset in range(0, n_patients, chunk_size):
+        write_table(pd.DataFrame({
+            'Id': patient_ids[offset:offset + chunk_size],
+            'BIRTHDATE': np.datetime_as_string(birthdates[offset:offset + chunk_size]),
+            'GENDER': rng.choice(['M', 'F'], len(patient_ids[offset:offset + chunk_size]))
+        }), os.path.join(data_dir, 'patients.csv'), PATIENTS_HEADER)
+
+    procedure_costs = rng.lognormal(6.2, 0.6, N_PROCEDURE_TYPES).round(2)
+    span = (STOP_DATE - START_DATE).astype('timedelta64[s]').astype(np.int64)
+    n_chunks = max(1, -(-n_encounters // chunk_size))
+    for chunk in range(n_chunks):
+        n = min(chunk_size, n_encounters - chunk * chunk_size)
+        low, high = span * chunk // n_chunks, span * (chunk + 1) // n_chunks
+        start = START_DATE + np.sort(rng.integers(low, high, n)).astype('timedelta64[s]')
+        stop = start + (rng.exponential(5 * 60, n).astype(np.int64) + 1).astype('timedelta64[m]')
+
+        payer = rng.integers(0, len(PAYER_NAMES), n)
+        total_claim_cost = rng.lognormal(7.4, 0.7, n).round(2)
+        is_covered = np.array(PAYER_NAMES)[payer] != 'NO_INSURANCE'
+        encounter_ids = make_ids(rng, n)
+        patients = patient_ids[rng.integers(0, n_patients, n)]
+
+        write_table(pd.DataFrame({
+            'Id': encounter_ids,
+            'START': format_times(start),
+            'STOP': format_times(stop),
+            'PATIENT': patients,
+            'ORGANIZATION': organization_id,
+            'PAYER': payer_ids[payer],
+            'ENCOUNTERCLASS': rng.choice(list(ENCOUNTER_CLASSES), n, p=list(ENCOUNTER_CLASSES.values())),
+            'CODE': 1,
+            'DESCRIPTION': rng.choice(['A', 'B', 'C'], n),
+            'BASE_ENCOUNTER_COST': 85.55,
+            'TOTAL_CLAIM_COST': total_claim_cost,
+            'PAYER_COVERAGE': np.where(is_covered, (total_claim_cost * rng.uniform(0, 0.5, n)).round(2), 0)
+        }), os.path.join(data_dir, 'encounters.csv'), ENCOUNTERS_HEADER)
+
+        encounter = np.repeat(np.arange(n), rng.poisson(PROCEDURES_PER_ENCOUNTER, n))
+        procedure = rng.integers(0, N_PROCEDURE_TYPES, len(encounter))
+        write_table(pd.DataFrame({
+            'START': format_times(start[encounter]),
+            'STOP': format_times(stop[encounter]),
+            'PATIENT': patients[encounter],
+            'ENCOUNTER': encounter_ids[encounter],
+            'CODE': 1,
+            'DESCRIPTION': np.char.add('Procedure ', (procedure + 1).astype(str)),
+            'BASE_COST': (procedure_costs[procedure] * rng.uniform(0.5, 1.5, len(encounter))).round(2)
+        }), os.path.join(data_dir, 'procedures.csv'), PROCEDURES_HEADER)
+
+def measure(results, stage, rows, function, *args):
+    # Peak RSS is sampled in the background because the process-wide peak would include every earlier stage
+    rss_before = get_rss()
+    peak = [rss_before]
+    is_done = threading.Event()
+
+    def sample():
+        while not is_done.wait(0.005):
+            peak[0] = max(peak[0], get_rss())
+
+    sampler = threading.Thread(target=sample, daemon=True)
+    sampler.start()
+    start = time.perf_counter()
+    result = function(*args)
+    seconds = time.perf_counter() - start
+    is_done.set()
+    sampler.join()
+    peak[0] = max(peak[0], get_rss())
+
+    results.append({
+        'stage': stage,
+        'rows': int(rows),
+        'seconds': seconds,
+        'rows_per_second': rows / seconds if seconds > 0 else None,
+        'peak_rss_bytes': peak[0],
+        'rss_delta_bytes': get_rss() - rss_before
+    })
+
+    return result
+
+def run_benchmark(data_dir):
+    results = []
+    path = lambda table: os.path.join(data_dir, f'{table}.csv')
+
+    encounters = measure(results, 'read_encounters', count_rows(path('encounters')), lambda: read_csv(path('encounters'))[ENCOUNTERS_COLUMNS])
+    procedures = measure(results, 'read_procedures', count_rows(path('procedures')), lambda: read_csv(path('procedures'))[PROCEDURES_COLUMNS])
+    patients = measure(results, 'read_patients', count_rows(path('patients')), lambda: read_csv(path('patients'))[PATIENTS_COLUMNS])
+    payers = read_csv(path('payers'))[PAYERS_COLUMNS]
+
+    encounters = measure(results, 'transform_encounters', len(encounters), transform_encounters, encounters)
+    current_date = encounters['START'].max().date()
+
+    admissions = encounters[encounters['ENCOUNTERCLASS'] == 'inpatient']
+    measure(results, 'flag_readmissions', len(admissions), flag_readmissions, admissions)
+
+    df_encounters = measure(results, 'create_df_encounters', len(encounters), create_df_encounters, encounters, patients, payers, procedures, AGE_GROUPS, current_date)
+    df_procedure_coverage = measure(results, 'create_df_procedure_coverage', len(procedures), create_df_procedure_coverage, procedures, df_encounters)
+
+    cube_encounters = measure(results, 'create_cube_encounters', len(df_encounters), create_cube_encounters, df_encounters)
+    cube_patients = measure(results, 'create_cube_patients', len(df_encounters), create_cube_patients, df_encounters)
+    cube_procedures = measure(results, 'create_cube_procedures', len(df_procedure_coverage), create_cube_procedures, df_procedure_coverage)
+
+    # The result cache is bypassed so that every run times the rollup itself
+    measure(results, 'get_admissions_grouped', len(cube_encounters), get_admissions_grouped.__wrapped__, cube_encounters, cube_patients)
+    for function in [get_readmissions_grouped, get_length_grouped, get_length_by_age_group_grouped, get_cost_grouped,
+                     get_cost_by_encounter_class_grouped, get_encounter_coverage_grouped]:
+        measure(results, function.__name__, len(cube_encounters), function.__wrapped__, cube_encounters)
+    measure(results, 'get_procedure_coverage_grouped', len(cube_procedures), get_procedure_coverage_grouped.__wrapped__, cube_procedures)
+
+    return results
+
+def run_chunked_benchmark(data_dir, chunk_size, n_workers):
+    # The stages above hold whole tables, so past memory the chunked build is timed instead. It reads data/*.csv and
+    # writes data/.cache under the working directory as the service does, so it runs from the parent of the data directory.
+    # Peak RSS is of this process only, and leaves out workers when there is more than one
+    results = []
+    cwd = os.getcwd()
+    os.chdir(os.path.dirname(os.path.abspath(data_dir)))
+    try:
+        frames, _ = measure(results, 'build_cubes_chunked', count_rows(get_source_path('encounters')), build_cubes_chunked, AGE_GROUPS, None, chunk_size, n_workers)
+        for df in frames.values():
+            if isinstance(df, str):
+                os.remove(df)
+    finally:
+        os.chdir(cwd)
+
+    return results
+
+def get_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare_runs(run, baseline):
+    baseline_seconds = {stage['stage']: stage['seconds'] for stage in baseline['stages']}
+    lines = [f"{'stage':<36}{'seconds':>12}{'baseline':>12}{'ratio':>8}"]
+    for stage in run['stages']:
+        previous = baseline_seconds.get(stage['stage'])
+        ratio = f"{stage['seconds'] / previous:.2f}" if previous else '-'
+        lines.append(f"{stage['stage']:<36}{stage['seconds']:>12.4f}{previous if previous is not None else float('nan'):>12.4f}{ratio:>8}")
+
+    return '\n'.join(lines)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Time each helper.py stage on synthetic data of a given scale')
+    parser.add_argument('--encounters', type=float, default=1e5, help='number of encounters to generate, e.g. 1e5 to 1e8')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--data-dir', help='directory of generated CSVs, reused when it already exists')
+    parser.add_argument('--chunk-size', type=int, default=1_000_000, help='rows generated and written at a time')
+    parser.add_argument('--chunked', type=int, metavar='ROWS', help='time the chunked cube build with partitions of about this many rows instead of each stage')
+    parser.add_argument('--workers', type=int, default=1, help='worker processes of the chunked cube build')
+    parser.add_argument('--output', help='write the JSON results here instead of stdout')
+    parser.add_argument('--baseline', help='JSON results of an earlier run to compare against')
+    args = parser.parse_args()
+
+    n_encounters = int(args.encounters)
+    data_dir = args.data_dir or os.path.join('bench_data', f'{n_encounters}-{args.seed}', 'data')
+    if args.chunked and os.path.basename(os.path.normpath(data_dir)) != 'data':
+        parser.error('--chunked reads the CSVs from a directory named data, like the service')
+    if not os.path.exists(os.path.join(data_dir, 'procedures.csv')):
+        generate_data(n_encounters, data_dir, args.seed, args.chunk_size)
+
+    run = {
+        'commit': get_commit(),
+        'created': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'pandas': pd.__version__,
+        'numpy': np.__version__,
+        'encounters': n_encounters,
+        'seed': args.seed,
+        'chunked': args.chunked,
+        'workers': args.workers if args.chunked else None,
+        'stages': run_chunked_benchmark(data_dir, args.chunked, args.workers) if args.chunked else run_benchmark(data_dir)
+    }
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(run, f, indent=2)
+    else:
+        json.dump(run, sys.stdout, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            print(compare_runs(run, json.load(f)), file=sys.stderr)
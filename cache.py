@@ -0,0 +1,167 @@
+import datetime
+import functools
+import hashlib
+import json
+import os
+import pickle
+import tempfile
+import threading
+import weakref
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+from profiling import profiled
+
+# Memory is bounded by the estimated size of the cached results, and the disk tier is only used when a directory is set
+MAX_BYTES = int(os.environ.get('RESULT_CACHE_MAX_BYTES', 256 << 20))
+DISK_DIR = os.environ.get('RESULT_CACHE_DIR')
+DISK_MAX_BYTES = int(os.environ.get('RESULT_CACHE_DISK_MAX_BYTES', 1 << 30))
+
+ENTRIES = OrderedDict()
+VERSIONS = {}
+STATS = {'hits': 0, 'misses': 0, 'evictions': 0, 'disk_hits': 0, 'disk_writes': 0, 'disk_evictions': 0, 'bytes': 0}
+LOCK = threading.Lock()
+
+def set_version(df, version):
+    # A registered version stands in for the frame's contents, so the frame never has to be hashed
+    VERSIONS[id(df)] = (weakref.ref(df), version)
+    weakref.finalize(df, VERSIONS.pop, id(df), None)
+
+    return df
+
+def get_version(df):
+    ref, version = VERSIONS.get(id(df), (None, None))
+    if ref is not None and ref() is df:
+        return version
+
+    return None
+
+def get_fingerprint(value):
+    if isinstance(value, pd.DataFrame):
+        version = get_version(value)
+        if version is not None:
+            return version
+
+        # Frames without a version are addressed by their contents
+        return hashlib.sha256(pd.util.hash_pandas_object(value).to_numpy().tobytes() + str(list(value.columns)).encode()).hexdigest()
+
+    # Arrays are addressed by their contents too, since their text is truncated and two arrays can print the same
+    if isinstance(value, (pd.Series, pd.Index)):
+        return hashlib.sha256(pd.util.hash_pandas_object(value).to_numpy().tobytes() + str((value.name, value.dtype)).encode()).hexdigest()
+    if isinstance(value, np.ndarray):
+        return hashlib.sha256(get_fingerprint(pd.Series(value.ravel())).encode() + str(value.shape).encode()).hexdigest()
+
+    return json.dumps(value, sort_keys=True, default=get_json_fingerprint)
+
+def get_json_fingerprint(value):
+    # Values inside lists and dicts that JSON has no type for, where only scalars whose text is their value are kept as text
+    if isinstance(value, (pd.DataFrame, pd.Series, pd.Index, np.ndarray)):
+        return get_fingerprint(value)
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, (set, frozenset)):
+        return sorted(value, key=get_fingerprint)
+    if isinstance(value, (datetime.date, datetime.timedelta, pd.Timedelta, pd.Timestamp, pd.Period)):
+        return str(value)
+
+    raise TypeError(f'Cannot fingerprint {type(value).__name__} arguments of a cached function')
+
+@profiled
+def get_key(function, args, kwargs):
+    fingerprints = [get_fingerprint(arg) for arg in args] + [f'{name}={get_fingerprint(arg)}' for name, arg in sorted(kwargs.items())]
+
+    return hashlib.sha256('\n'.join([function.__module__, function.__qualname__] + fingerprints).encode()).hexdigest()
+
+def get_size(value):
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(index=True, deep=True).sum())
+
+    return len(pickle.dumps(value))
+
+def copy_result(value):
+    # Callers get their own copy, so changing a result cannot change what is cached
+    return value.copy() if isinstance(value, pd.DataFrame) else value
+
+def get_disk_path(key):
+    return os.path.join(DISK_DIR, f'{key}.pkl')
+
+def read_disk(key):
+    if DISK_DIR is None or not os.path.exists(get_disk_path(key)):
+        return None
+
+    with open(get_disk_path(key), 'rb') as f:
+        return pickle.load(f)
+
+def write_disk(key, value):
+    if DISK_DIR is None:
+        return
+
+    os.makedirs(DISK_DIR, exist_ok=True)
+    handle, temp_path = tempfile.mkstemp(dir=DISK_DIR, suffix='.tmp')
+    with os.fdopen(handle, 'wb') as f:
+        pickle.dump(value, f)
+    os.replace(temp_path, get_disk_path(key))
+    STATS['disk_writes'] += 1
+
+    # The least recently written files go first once the directory is over its bound
+    paths = sorted((os.path.join(DISK_DIR, name) for name in os.listdir(DISK_DIR) if name.endswith('.pkl')), key=os.path.getmtime)
+    disk_bytes = sum(os.path.getsize(path) for path in paths)
+    for path in paths[:-1]:
+        if disk_bytes <= DISK_MAX_BYTES:
+            break
+        disk_bytes -= os.path.getsize(path)
+        os.remove(path)
+        STATS['disk_evictions'] += 1
+
+def put(key, value):
+    size = get_size(value)
+    if size > MAX_BYTES:
+        return
+
+    ENTRIES[key] = (value, size)
+    STATS['bytes'] += size
+    while STATS['bytes'] > MAX_BYTES:
+        _, (_, evicted_size) = ENTRIES.popitem(last=False)
+        STATS['bytes'] -= evicted_size
+        STATS['evictions'] += 1
+
+def cached(function):
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        key = get_key(function, args, kwargs)
+
+        with LOCK:
+            if key in ENTRIES:
+                ENTRIES.move_to_end(key)
+                STATS['hits'] += 1
+                return copy_result(ENTRIES[key][0])
+
+            value = read_disk(key)
+            if value is not None:
+                STATS['disk_hits'] += 1
+                put(key, value)
+                return copy_result(value)
+
+            STATS['misses'] += 1
+
+        value = function(*args, **kwargs)
+
+        with LOCK:
+            if key not in ENTRIES:
+                put(key, value)
+                write_disk(key, value)
+
+        return copy_result(value)
+
+    return wrapper
+
+def get_cache_stats():
+    with LOCK:
+        return dict(STATS, entries=len(ENTRIES), max_bytes=MAX_BYTES)
+
+def clear_cache():
+    with LOCK:
+        ENTRIES.clear()
+        STATS['bytes'] = 0
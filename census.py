@@ -0,0 +1,96 @@
+import numpy as np
+import pandas as pd
+
+from cache import cached
+from profiling import profiled
+
+# Census is counted per hour: an encounter is present in every hour its stay overlaps, and in its starting hour when it has no length
+CENSUS_DIMENSIONS = ['ORGANIZATION', 'ENCOUNTERCLASS', 'HOUR']
+HOUR = 3_600_000_000_000 # nanoseconds
+
+@profiled
+def create_cube_census(encounters):
+    # Each stay is an arrival at its first hour and a departure after its last, so the census is a running sum of these events.
+    # The events add up across batches and partitions like any other cube
+    encounters = encounters[encounters['STOP'].notna()]
+    start = pd.DatetimeIndex(encounters['START']).asi8
+    stop = pd.DatetimeIndex(encounters['STOP']).asi8
+    arrival = start // HOUR
+    departure = np.maximum(-(-stop // HOUR), arrival + 1)
+
+    df_events = pd.DataFrame({
+        'ORGANIZATION': np.tile(encounters['ORGANIZATION'].to_numpy(), 2),
+        'ENCOUNTERCLASS': pd.Categorical(np.tile(encounters['ENCOUNTERCLASS'].to_numpy(), 2), dtype=encounters['ENCOUNTERCLASS'].dtype),
+        'HOUR': np.concatenate([arrival, departure]),
+        'DELTA': np.repeat([1, -1], len(encounters))
+    })
+    cube_census = df_events.groupby(CENSUS_DIMENSIONS, observed=True, dropna=False)['DELTA'].sum().reset_index()
+
+    return cube_census
+
+@profiled
+def get_census(cube_census, by):
+    # The census of a group only changes at its event hours, so one pass over the sorted events gives it as runs of hours
+    # with the same census, split at month starts, instead of a census for every hour of every group.
+    # Every group covers the hours from the first event to the last one of any group, with a census of 0 when nothing is open
+    df_events = cube_census.groupby(list(by) + ['HOUR'], observed=True)['DELTA'].sum().reset_index()
+    if len(df_events) == 0:
+        return pd.DataFrame(columns=list(by) + ['HOUR', 'HOURS', 'CENSUS'])
+
+    first_hour, last_hour = df_events['HOUR'].min(), df_events['HOUR'].max()
+    if by:
+        group = df_events.groupby(list(by), observed=True, sort=True).ngroup().to_numpy()
+        groups = df_events[list(by)].iloc[np.unique(group, return_index=True)[1]].reset_index(drop=True)
+    else:
+        group = np.zeros(len(df_events), dtype=int)
+        groups = pd.DataFrame(index=range(1))
+    hour = df_events['HOUR'].to_numpy(dtype=np.int64)
+    census = pd.Series(df_events['DELTA'].to_numpy()).groupby(group).cumsum().to_numpy()
+
+    # Runs start at every event hour and every month start of every group, keyed by group and hour so that they sort together
+    first_month, last_month = np.array([first_hour, last_hour], dtype=np.int64).astype('datetime64[h]').astype('datetime64[M]')
+    months = np.arange(first_month, last_month + 1)
+    month_starts = np.maximum(months.astype('datetime64[h]').astype(np.int64), first_hour)
+    span = last_hour - first_hour + 1
+    event_keys = group * span + (hour - first_hour)
+    keys = np.union1d(event_keys, (np.arange(len(groups))[:, None] * span + (month_starts - first_hour)).ravel())
+    run_group, run_hour = keys // span, keys % span + first_hour
+
+    # A run lasts until the next run of its group, and the census in it is the running sum of the group's events up to its start
+    is_last = np.append(run_group[1:] != run_group[:-1], True)
+    run_stop = np.where(is_last, last_hour + 1, np.append(run_hour[1:], 0))
+    event = np.maximum(np.searchsorted(event_keys, keys, 'right') - 1, 0)
+    run_census = np.where(group[event] == run_group, census[event], 0)
+
+    df_census = pd.DataFrame({column: groups[column].to_numpy()[run_group] for column in groups.columns})
+    df_census['HOUR'] = run_hour
+    df_census['HOURS'] = run_stop - run_hour
+    df_census['CENSUS'] = run_census
+
+    return df_census
+
+@cached
+@profiled
+def get_census_grouped(cube_census, by):
+    # Peak, mean and 95th percentile of the hourly census come from the runs weighted by their hours,
+    # with the percentile interpolated between the two hours around it the way a quantile of every hour would be
+    df_census = get_census(cube_census, by)
+    df_census['START_MONTH'] = df_census['HOUR'].to_numpy(dtype=np.int64).astype('datetime64[h]').astype('datetime64[M]').astype(np.int32)
+    df_census = df_census.sort_values(['START_MONTH'] + list(by) + ['CENSUS'], kind='stable', ignore_index=True)
+    df_census['CENSUS_HOURS'] = df_census['CENSUS'] * df_census['HOURS']
+
+    grouped = df_census.groupby(['START_MONTH'] + list(by), observed=True, sort=True)
+    df_census_grouped = grouped.agg(PEAK_CENSUS=('CENSUS', 'max'), HOURS=('HOURS', 'sum'), CENSUS_HOURS=('CENSUS_HOURS', 'sum'))
+    df_census_grouped['MEAN_CENSUS'] = df_census_grouped['CENSUS_HOURS'] / df_census_grouped['HOURS']
+
+    hours = df_census_grouped['HOURS'].to_numpy()
+    first_hours = np.cumsum(hours) - hours
+    position = 0.95 * (hours - 1)
+    low = np.floor(position).astype(np.int64)
+    high = np.minimum(low + 1, hours - 1)
+    census, run_stops = df_census['CENSUS'].to_numpy(), np.cumsum(df_census['HOURS'].to_numpy())
+    census_low = census[np.searchsorted(run_stops, first_hours + low, 'right')]
+    census_high = census[np.searchsorted(run_stops, first_hours + high, 'right')]
+    df_census_grouped['P95_CENSUS'] = census_low + (census_high - census_low) * (position % 1)
+
+    return df_census_grouped.reset_index()[['START_MONTH'] + list(by) + ['PEAK_CENSUS', 'P95_CENSUS', 'MEAN_CENSUS']]
@@ -0,0 +1,184 @@
+import json
+
+import numpy as np
+import pandas as pd
+import plotly.express as px
+
+from profiling import profiled
+
+# Each tab is a narrative line and a Plotly figure, built from the records of a report
+# The oldest month has no previous month in its report, so its comparisons show the one month without a change
+NO_PREVIOUS_MONTH = 'There is no previous month to compare {} with.'
+
+def get_month_colors(n_months):
+    # The selected month is the darker bar whether or not the previous month is shown
+    return ['#c3e4ec', '#048cb3'][-n_months:]
+
+def to_spec(figure):
+    # Plain JSON rather than a Figure, so that the spec can be stored and sent as bytes
+    return json.loads(figure.to_json())
+
+def get_readmissions_markdown(values):
+    readmissions_change = (values[len(values)-1] - values[len(values)-2]) / values[len(values)-2]
+    readmissions_direction = 'decreased' if readmissions_change < 0 else 'increased'
+    if abs(readmissions_change) < 1:
+        readmissions_markdown = f'Patients readmitted ***{readmissions_direction}*** by ***{abs(readmissions_change):.0%}*** from previous month.'
+    elif abs(readmissions_change) > 1:
+        if readmissions_change == np.inf:
+            readmissions_markdown = f'Patients readmitted ***{readmissions_direction}*** by ***100%*** from previous month.'
+        else:
+            readmissions_markdown = f'Patients readmitted ***{readmissions_direction} {abs(readmissions_change):.1f}x*** from previous month.'
+    elif readmissions_change == 1:
+        readmissions_markdown = f'Patients readmitted ***remained the same*** from previous month.'
+    elif readmissions_change == -1:
+        readmissions_markdown = f'Patients readmitted ***{readmissions_direction}*** by ***{abs(readmissions_change):.0%}*** from previous month.'
+
+    return readmissions_markdown
+
+def create_admissions_chart(records):
+    df_admissions_grouped = pd.DataFrame(records)
+    df_admissions_grouped['START_MONTH'] = pd.to_datetime(df_admissions_grouped['START_MONTH']).dt.strftime('%b %Y')
+    n_months = len(df_admissions_grouped)
+    df_admissions_grouped = df_admissions_grouped.melt(id_vars='START_MONTH')
+    df_admissions_grouped['variable'] = df_admissions_grouped['variable'].str.title()
+
+    if n_months < 2:
+        readmissions_markdown = NO_PREVIOUS_MONTH.format('patients readmitted')
+    else:
+        readmissions_markdown = get_readmissions_markdown(df_admissions_grouped['value'])
+
+    admissions_grouped = px.bar(df_admissions_grouped, x='variable', y='value', color='START_MONTH', barmode='group', color_discrete_sequence=get_month_colors(n_months))
+    admissions_grouped.update_layout(xaxis_title='Number of patients', yaxis_title=None, yaxis=dict(showgrid=False), showlegend=True, legend_title=None, legend=dict(orientation='h', yanchor='top', y=1, xanchor='center', x=0.5))
+    admissions_grouped.update_traces(hovertemplate='<b>%{y:,} patients</b>')
+
+    return readmissions_markdown, admissions_grouped
+
+def create_readmissions_chart(records):
+    df_readmissions_grouped = pd.DataFrame(records)
+    df_readmissions_grouped['START_MONTH'] = pd.to_datetime(df_readmissions_grouped['START_MONTH']).dt.strftime('%b %Y')
+
+    highest_readmission_groups = df_readmissions_grouped[df_readmissions_grouped['READMISSIONS'] == df_readmissions_grouped['READMISSIONS'].max()]['AGE_GROUP']
+    highest_readmission_groups_count = len(highest_readmission_groups)
+    highest_readmission_groups_str = ' and '.join(highest_readmission_groups)
+    start_month = df_readmissions_grouped['START_MONTH'][0]
+    if highest_readmission_groups_count == 1:
+        readmissions_markdown = f'Age group ***{highest_readmission_groups_str}*** had the most readmissions in {start_month}.'
+    elif highest_readmission_groups_count > 1:
+        readmissions_markdown = f'Age groups ***{highest_readmission_groups_str}*** had the most readmissions in {start_month}.'
+
+    readmissions_grouped = px.bar(df_readmissions_grouped, x='READMISSIONS', y='AGE_GROUP', color='AGE_GROUP', orientation='h', color_discrete_sequence=['#c3e4ec'], color_discrete_map=dict(zip(highest_readmission_groups, ['#048cb3']*highest_readmission_groups_count)))
+    readmissions_grouped.update_layout(xaxis_title='Number of readmissions', yaxis_title=None, showlegend=False)
+    readmissions_grouped.update_traces(hovertemplate='<b>%{x:,} readmission(s)</b>')
+
+    return readmissions_markdown, readmissions_grouped
+
+def create_cost_chart(records):
+    df_cost_grouped = pd.DataFrame(records)
+    df_cost_grouped['START_MONTH'] = pd.to_datetime(df_cost_grouped['START_MONTH']).dt.strftime('%b %Y')
+
+    if len(df_cost_grouped) < 2:
+        cost_markdown = NO_PREVIOUS_MONTH.format('the average encounter cost')
+    else:
+        cost_change = (df_cost_grouped['AVERAGE_COST'][1] - df_cost_grouped['AVERAGE_COST'][0]) / df_cost_grouped['AVERAGE_COST'][0]
+        cost_direction = 'decreased' if cost_change < 0 else 'increased'
+        cost_markdown = f'Average encounter cost ***{cost_direction}*** by ***{abs(cost_change):.0%}*** from previous month.'
+
+    cost_grouped = px.bar(df_cost_grouped, x='START_MONTH', y='AVERAGE_COST', color='START_MONTH', color_discrete_sequence=get_month_colors(len(df_cost_grouped)))
+    cost_grouped.update_layout(xaxis_title=None, yaxis_title='Average cost of encounter', yaxis=dict(showgrid=False), showlegend=False)
+    cost_grouped.update_traces(hovertemplate='<b>$%{y:,.2f}</b>')
+
+    return cost_markdown, cost_grouped
+
+def create_cost_by_encounter_class_chart(records):
+    df_cost_by_encounter_class_grouped = pd.DataFrame(records)
+    df_cost_by_encounter_class_grouped['START_MONTH'] = pd.to_datetime(df_cost_by_encounter_class_grouped['START_MONTH']).dt.strftime('%b %Y')
+
+    highest_cost_group = df_cost_by_encounter_class_grouped['ENCOUNTERCLASS'][0]
+    highest_cost = df_cost_by_encounter_class_grouped['AVERAGE_COST'][0]
+    start_month = df_cost_by_encounter_class_grouped['START_MONTH'][0]
+    cost_markdown = f'Encounter class ***{highest_cost_group}*** had the highest average cost of ***${highest_cost:,.0f}*** in {start_month}.'
+
+    cost_by_encounter_class_grouped = px.bar(df_cost_by_encounter_class_grouped, x='AVERAGE_COST', y='ENCOUNTERCLASS', color='ENCOUNTERCLASS', orientation='h', color_discrete_sequence=['#c3e4ec'], color_discrete_map={highest_cost_group: '#048cb3'})
+    cost_by_encounter_class_grouped.update_layout(xaxis_title='Average cost of encounter', yaxis_title=None, showlegend=False)
+    cost_by_encounter_class_grouped.update_traces(hovertemplate='<b>$%{x:,.2f}</b>')
+
+    return cost_markdown, cost_by_encounter_class_grouped
+
+def create_length_chart(records):
+    df_length_grouped = pd.DataFrame(records)
+    df_length_grouped['START_MONTH'] = pd.to_datetime(df_length_grouped['START_MONTH']).dt.strftime('%b %Y')
+
+    if len(df_length_grouped) < 2:
+        length_markdown = NO_PREVIOUS_MONTH.format('the average length of stay')
+    else:
+        length_change = (df_length_grouped['AVERAGE_DURATION'][1] - df_length_grouped['AVERAGE_DURATION'][0]) / df_length_grouped['AVERAGE_DURATION'][0]
+        length_direction = 'decreased' if length_change < 0 else 'increased'
+        length_markdown = f'Average length of stay ***{length_direction}*** by ***{abs(length_change):.0%}*** from previous month.'
+
+    length_grouped = px.bar(df_length_grouped, x='START_MONTH', y='AVERAGE_DURATION', color='START_MONTH', color_discrete_sequence=get_month_colors(len(df_length_grouped)))
+    length_grouped.update_layout(xaxis_title=None, yaxis_title='Average duration of encounter', yaxis=dict(showgrid=False), showlegend=False)
+    length_grouped.update_traces(hovertemplate='<b>%{y:,.1f} hours</b>')
+
+    return length_markdown, length_grouped
+
+def create_length_by_age_group_chart(records):
+    df_length_by_age_group_grouped = pd.DataFrame(records)
+    df_length_by_age_group_grouped['START_MONTH'] = pd.to_datetime(df_length_by_age_group_grouped['START_MONTH']).dt.strftime('%b %Y')
+
+    highest_length_group = df_length_by_age_group_grouped['AGE_GROUP'][0]
+    highest_length = df_length_by_age_group_grouped['AVERAGE_DURATION'][0]
+    start_month = df_length_by_age_group_grouped['START_MONTH'][0]
+    length_markdown = f'Age group ***{highest_length_group}*** had the longest average stay of ***{highest_length:.1f} hours*** in {start_month}.'
+
+    length_by_age_group_grouped = px.bar(df_length_by_age_group_grouped, x='AVERAGE_DURATION', y='AGE_GROUP', color='AGE_GROUP', orientation='h', color_discrete_sequence=['#c3e4ec'], color_discrete_map={highest_length_group: '#048cb3'})
+    length_by_age_group_grouped.update_layout(xaxis_title='Average duration of encounter', yaxis_title=None, showlegend=False)
+    length_by_age_group_grouped.update_traces(hovertemplate='<b>%{x:,.1f} hours</b>')
+
+    return length_markdown, length_by_age_group_grouped
+
+def create_encounter_coverage_chart(records):
+    df_encounter_coverage_grouped = pd.DataFrame(records)
+    df_encounter_coverage_grouped['START_MONTH'] = pd.to_datetime(df_encounter_coverage_grouped['START_MONTH']).dt.strftime('%b %Y')
+
+    if len(df_encounter_coverage_grouped) < 2:
+        coverage_markdown = NO_PREVIOUS_MONTH.format('the percentage of procedures covered by insurance')
+    else:
+        coverage_change = (df_encounter_coverage_grouped['COVERAGE_RATE_COUNT'][1] - df_encounter_coverage_grouped['COVERAGE_RATE_COUNT'][0])
+        coverage_direction = 'decreased' if coverage_change < 0 else 'increased'
+        coverage_markdown = f'Percentage of procedures covered by insurance ***{coverage_direction}*** by ***{abs(coverage_change):.0%}*** from previous month.'
+
+    encounter_coverage_grouped = px.bar(df_encounter_coverage_grouped, x='START_MONTH', y='COVERAGE_RATE_COUNT', color='START_MONTH', color_discrete_sequence=get_month_colors(len(df_encounter_coverage_grouped)))
+    encounter_coverage_grouped.update_layout(xaxis_title=None, yaxis_title='Percentage of procedures covered', yaxis=dict(showgrid=False, tickformat=',.0%'), showlegend=False)
+    encounter_coverage_grouped.update_traces(hovertemplate='<b>%{y:,.0%}</b>')
+
+    return coverage_markdown, encounter_coverage_grouped
+
+def create_procedure_coverage_chart(records, selected_month):
+    df_procedure_coverage_grouped = pd.DataFrame(records)
+
+    highest_expense_group = df_procedure_coverage_grouped['DESCRIPTION'][0]
+    highest_expense = df_procedure_coverage_grouped['BASE_COST'][0]
+    start_month = pd.to_datetime(selected_month).strftime('%b %Y')
+    procedure_markdown = f'***{highest_expense_group}*** is the most expensive procedure on non-insured patients in {start_month}, with average cost of ***${highest_expense:,.0f}***.'
+
+    procedure_coverage_grouped = px.bar(df_procedure_coverage_grouped, x='BASE_COST', y='DESCRIPTION', color='DESCRIPTION', orientation='h', color_discrete_sequence=['#c3e4ec'], color_discrete_map={highest_expense_group: '#048cb3'})
+    procedure_coverage_grouped.update_layout(xaxis_title='Average cost of procedure', yaxis_title=None, showlegend=False)
+    procedure_coverage_grouped.update_traces(textposition='inside', hovertemplate='<b>$%{x:,.2f}</b>')
+
+    return procedure_markdown, procedure_coverage_grouped
+
+@profiled
+def create_charts(report):
+    tabs = report['tabs']
+    charts = {
+        'admissions': create_admissions_chart(tabs['admissions']),
+        'readmissions': create_readmissions_chart(tabs['readmissions']),
+        'cost': create_cost_chart(tabs['cost']),
+        'cost_by_encounter_class': create_cost_by_encounter_class_chart(tabs['cost_by_encounter_class']),
+        'length': create_length_chart(tabs['length']),
+        'length_by_age_group': create_length_by_age_group_chart(tabs['length_by_age_group']),
+        'encounter_coverage': create_encounter_coverage_chart(tabs['encounter_coverage']),
+        'procedure_coverage': create_procedure_coverage_chart(tabs['procedure_coverage'], report['month'])
+    }
+
+    return {name: {'markdown': markdown, 'figure': to_spec(figure)} for name, (markdown, figure) in charts.items()}
@@ -0,0 +1,324 @@
+import math
+import os
+import tempfile
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+
+from census import create_cube_census
+from helper import *
+from incremental import CUBE_DIMENSIONS, STATE_KEYS, combine_cube, combine_frames, create_state
+from loader import CACHE_DIR, CATEGORY_COLUMNS, KEY_COLUMNS, build_cache, count_rows, get_source_path, get_temp_path, is_cache_valid, iter_csv, load_table
+from profiling import profiled
+
+# Sorted runs merged at once, each read a block of at least MIN_BLOCK_ROWS rows at a time
+FAN_IN = 64
+MIN_BLOCK_ROWS = 1024
+# Spill files open at once, below the usual limits on open files, and rows buffered before they are written, in chunks
+MAX_SPILL_FILES = 128
+SPILL_BUFFER_CHUNKS = 8
+
+def get_partitions(patients, n_partitions):
+    # Partitioning by patient keeps all of a patient's encounters and procedures together,
+    # so readmissions, the procedure join and distinct patient counts are exact within a partition
+    return np.mod(patients.to_numpy(dtype=np.int64, na_value=0), n_partitions)
+
+def get_partition_path(spill_dir, table, partition):
+    return os.path.join(spill_dir, f'{table}-{partition}.arrow')
+
+def get_bucket_path(spill_dir, table, bucket):
+    return os.path.join(spill_dir, f'{table}-bucket-{bucket}.arrow')
+
+def to_spill(df):
+    # Categories differ from chunk to chunk, so they are spilled as strings and keys as nullable codes
+    df = df.copy()
+    for column in df.columns.intersection(CATEGORY_COLUMNS):
+        df[column] = df[column].astype(object)
+    for column in df.columns.intersection(KEY_COLUMNS):
+        df[column] = df[column].astype('Int64')
+
+    return df
+
+def to_spill_table(df, partitions):
+    # A string column with no values in a chunk would come out untyped, and every chunk is written with the same schema
+    arrow_table = pa.Table.from_pandas(to_spill(df), preserve_index=False)
+    schema = pa.schema([field.with_type(pa.string()) if pa.types.is_null(field.type) else field for field in arrow_table.schema])
+
+    return arrow_table.cast(schema).append_column('PARTITION', pa.array(partitions))
+
+def from_spill(df):
+    for column in df.columns.intersection(CATEGORY_COLUMNS):
+        df[column] = df[column].astype('category')
+    for column in df.columns.intersection(KEY_COLUMNS):
+        if not df[column].isna().any():
+            df[column] = df[column].astype(np.int64)
+
+    return df
+
+def split_rows(keys):
+    # Row positions of each key, in one sort instead of a filter per key
+    order = np.argsort(keys, kind='stable')
+    values, starts = np.unique(keys[order], return_index=True)
+
+    return zip(values, np.split(order, starts[1:]))
+
+def write_buffer(writers, path, tables):
+    arrow_table = pa.concat_tables(tables)
+    if path not in writers:
+        writers[path] = pa.ipc.new_file(path, arrow_table.schema)
+    writers[path].write_table(arrow_table)
+
+def spill_partitions(chunks, spill_dir, table, n_partitions, buffer_rows):
+    # Rows go to at most MAX_SPILL_FILES bucket files, buffered so that each write holds many rows.
+    # A bucket holds one partition when there are few, and is split into its partitions after the pass otherwise,
+    # so files open at once stay bounded and the number of writes follows the rows rather than rows times partitions.
+    # Chunks are passed through so that the caller can gather what it needs in the same pass
+    n_buckets = min(n_partitions, MAX_SPILL_FILES)
+    get_path = get_partition_path if n_buckets == n_partitions else get_bucket_path
+    writers = {}
+    buffers = {bucket: [] for bucket in range(n_buckets)}
+    bucket_rows = max(1, buffer_rows // n_buckets)
+    try:
+        for df in chunks:
+            partitions = get_partitions(df['PATIENT'], n_partitions)
+            arrow_table = to_spill_table(df, partitions)
+            for bucket, rows in split_rows(partitions % n_buckets):
+                buffers[bucket].append(arrow_table.take(rows))
+                if sum(len(buffer) for buffer in buffers[bucket]) >= bucket_rows:
+                    write_buffer(writers, get_path(spill_dir, table, bucket), buffers[bucket])
+                    buffers[bucket] = []
+
+            yield df
+
+        for bucket, buffer in buffers.items():
+            if buffer:
+                write_buffer(writers, get_path(spill_dir, table, bucket), buffer)
+    finally:
+        for writer in writers.values():
+            writer.close()
+
+    if n_buckets < n_partitions:
+        for bucket in range(n_buckets):
+            split_bucket(spill_dir, table, bucket, n_partitions, buffer_rows)
+
+def split_bucket(spill_dir, table, bucket, n_partitions, buffer_rows):
+    # Only the partitions of one bucket are open at a time, and the bucket is read a block at a time
+    path = get_bucket_path(spill_dir, table, bucket)
+    if not os.path.exists(path):
+        return
+
+    writers = {}
+    buffers = {}
+    partition_rows = max(1, buffer_rows * MAX_SPILL_FILES // n_partitions)
+    try:
+        with pa.memory_map(path) as source:
+            reader = pa.ipc.open_file(source)
+            for i in range(reader.num_record_batches):
+                block = reader.get_batch(i)
+                for partition, rows in split_rows(block.column('PARTITION').to_numpy()):
+                    buffers.setdefault(partition, []).append(pa.Table.from_batches([block.take(rows)]))
+                    if sum(len(buffer) for buffer in buffers[partition]) >= partition_rows:
+                        write_buffer(writers, get_partition_path(spill_dir, table, partition), buffers.pop(partition))
+
+        for partition, buffer in buffers.items():
+            write_buffer(writers, get_partition_path(spill_dir, table, partition), buffer)
+    finally:
+        for writer in writers.values():
+            writer.close()
+
+    os.remove(path)
+
+def read_partition(spill_dir, table, partition, template):
+    path = get_partition_path(spill_dir, table, partition)
+    if not os.path.exists(path):
+        return template.copy()
+
+    with pa.memory_map(path) as source:
+        df = pa.ipc.open_file(source).read_all().drop_columns(['PARTITION']).to_pandas()
+
+    return from_spill(df)
+
+def get_sort_keys(values):
+    # Missing keys sort last, as they do in a sorted frame
+    return pc.fill_null(values.cast(pa.int64()), np.iinfo(np.int64).max).to_numpy()
+
+def write_run(df, path, block_rows):
+    arrow_table = pa.Table.from_pandas(df, preserve_index=False)
+    with pa.ipc.new_file(path, arrow_table.schema) as writer:
+        writer.write_table(arrow_table, max_chunksize=block_rows)
+
+def merge_files(paths, key, path, out_rows):
+    # Every run holds back its unread rows, so only rows up to the smallest last key among the blocks of runs
+    # that still have blocks to read are known to come next, and those are sorted and written out in blocks of out_rows
+    sources = [pa.memory_map(run_path) for run_path in paths]
+    readers = [pa.ipc.open_file(source) for source in sources]
+    next_blocks = [0] * len(readers)
+    blocks = [None] * len(readers)
+    keys = [None] * len(readers)
+    merged = []
+    with pa.ipc.new_file(path, readers[0].schema) as writer:
+        while True:
+            for i, reader in enumerate(readers):
+                while (blocks[i] is None or len(blocks[i]) == 0) and next_blocks[i] < reader.num_record_batches:
+                    blocks[i] = reader.get_batch(next_blocks[i])
+                    keys[i] = get_sort_keys(blocks[i].column(key))
+                    next_blocks[i] += 1
+
+            live = [i for i in range(len(readers)) if blocks[i] is not None and len(blocks[i]) > 0]
+            if merged and (not live or sum(len(block) for block in merged) >= out_rows):
+                writer.write_table(pa.concat_tables(merged).combine_chunks())
+                merged = []
+            if not live:
+                break
+
+            bounds = [keys[i][-1] for i in live if next_blocks[i] < readers[i].num_record_batches]
+            parts, part_keys = [], []
+            for i in live:
+                n = len(keys[i]) if not bounds else np.searchsorted(keys[i], min(bounds), 'right')
+                parts.append(blocks[i].slice(0, n))
+                part_keys.append(keys[i][:n])
+                blocks[i], keys[i] = blocks[i].slice(n), keys[i][n:]
+
+            merged.append(pa.Table.from_batches(parts).take(np.argsort(np.concatenate(part_keys), kind='stable')))
+
+    for source in sources:
+        source.close()
+
+    return path
+
+def merge_run_files(paths, key, path, spill_dir, block_rows, out_rows):
+    # Runs are merged FAN_IN at a time, in more than one pass when there are more of them, so memory follows the block size.
+    # Runs are kept in order and ties keep it, so the result is the stable sort of the runs one after the other.
+    # The merged file is written in larger blocks, since a lookup in it goes through its blocks one at a time
+    level = 0
+    while len(paths) > FAN_IN:
+        paths = [
+            merge_files(paths[i:i + FAN_IN], key, os.path.join(spill_dir, f'merge-{key}-{level}-{i}.arrow'), block_rows)
+            for i in range(0, len(paths), FAN_IN)
+        ]
+        level += 1
+
+    return merge_files(paths, key, path, out_rows)
+
+def fold_cube(cubes, cube, dimensions):
+    # Partition cubes are added into the running cube once they hold as many rows as it does,
+    # so memory follows the size of the cube rather than the number of partitions, and each cell is only regrouped a few times
+    cubes.append(cube)
+    if sum(len(pending) for pending in cubes[1:]) >= len(cubes[0]):
+        cubes[:] = [combine_cube(cubes[0], cubes[1:], dimensions)]
+
+# Inputs shared by every partition a process aggregates, set once per process by init_worker instead of sent with each task
+WORKER = {}
+
+def init_worker(spill_dir, templates, encounter_classes, age_groups:dict, current_date, readmission_window):
+    # Each worker loads the dimension tables from their memory-mapped cache once, so a task is only a partition number
+    WORKER.update({
+        'spill_dir': spill_dir,
+        'templates': templates,
+        'encounter_classes': encounter_classes,
+        'patients': load_table('patients', columns=PATIENTS_COLUMNS),
+        'payers': load_table('payers', columns=PAYERS_COLUMNS),
+        'age_groups': age_groups,
+        'current_date': current_date,
+        'readmission_window': readmission_window
+    })
+
+def aggregate_partition(partition):
+    encounters = transform_encounters(read_partition(WORKER['spill_dir'], 'encounters', partition, WORKER['templates']['encounters']))
+    # Every partition gets the same sorted categories, so their sorted states can be written to one file and merged
+    encounters['ENCOUNTERCLASS'] = encounters['ENCOUNTERCLASS'].cat.set_categories(WORKER['encounter_classes'])
+    procedures = read_partition(WORKER['spill_dir'], 'procedures', partition, WORKER['templates']['procedures'])
+
+    df_encounters = create_df_encounters(encounters, WORKER['patients'], WORKER['payers'], procedures, WORKER['age_groups'], WORKER['current_date'], WORKER['readmission_window'])
+    df_procedure_coverage = create_df_procedure_coverage(procedures, df_encounters)
+
+    partition_frames = {
+        'cube_encounters': create_cube_encounters(df_encounters),
+        'cube_patients': create_cube_patients(df_encounters),
+        'cube_procedures': create_cube_procedures(df_procedure_coverage),
+        'cube_census': create_cube_census(encounters)
+    }
+    partition_frames.update(create_state(df_encounters, df_procedure_coverage))
+
+    return partition_frames
+
+def iter_partitions(n_partitions, n_workers, initargs):
+    # At most two partitions per worker are in flight and they come back in partition order,
+    # so finished partitions do not pile up and any number of workers gives the same cubes
+    if n_workers == 1:
+        init_worker(*initargs)
+        try:
+            yield from map(aggregate_partition, range(n_partitions))
+        finally:
+            WORKER.clear()
+        return
+
+    # Workers starting together would each build a missing dimension table cache, so it is built once here first
+    for table in ['patients', 'payers']:
+        if not is_cache_valid(table):
+            build_cache(table)
+
+    with ProcessPoolExecutor(max_workers=n_workers, initializer=init_worker, initargs=initargs) as executor:
+        futures = deque()
+        for partition in range(n_partitions):
+            futures.append(executor.submit(aggregate_partition, partition))
+            if len(futures) >= 2 * n_workers:
+                yield futures.popleft().result()
+        while futures:
+            yield futures.popleft().result()
+
+@profiled
+def build_cubes_chunked(age_groups:dict, readmission_window=None, chunk_size=1 << 16, n_workers=1):
+    # Peak memory follows the chunk size and the size of the cubes: sources are streamed once into patient partitions
+    # of about chunk_size rows, each worker joins and aggregates one partition at a time, partition cubes are folded
+    # into running cubes, and partition states are written out as sorted runs that are merged into one file each
+    n_partitions = max(n_workers, math.ceil(count_rows(get_source_path('encounters')) / chunk_size))
+    block_rows = max(MIN_BLOCK_ROWS, chunk_size // FAN_IN)
+
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    with tempfile.TemporaryDirectory(dir=CACHE_DIR) as spill_dir:
+        current_date = None
+        encounter_classes = set()
+        chunks = spill_partitions(iter_csv(get_source_path('encounters'), columns=ENCOUNTERS_COLUMNS, chunk_size=chunk_size), spill_dir, 'encounters', n_partitions, SPILL_BUFFER_CHUNKS * chunk_size)
+        for df in chunks:
+            current_date = df['START'].max() if current_date is None else max(current_date, df['START'].max())
+            encounter_classes.update(df['ENCOUNTERCLASS'].cat.categories)
+            encounters_template = df.iloc[0:0]
+        current_date = current_date.date()
+
+        chunks = spill_partitions(iter_csv(get_source_path('procedures'), columns=PROCEDURES_COLUMNS, chunk_size=chunk_size), spill_dir, 'procedures', n_partitions, SPILL_BUFFER_CHUNKS * chunk_size)
+        for df in chunks:
+            procedures_template = df.iloc[0:0]
+
+        # Partitions hold disjoint patients, so every measure including distinct patients adds up across them
+        dimensions = dict(CUBE_DIMENSIONS, cube_patients=['START_MONTH'])
+        cubes = {name: [] for name in dimensions}
+        runs = {name: [] for name in STATE_KEYS}
+        states = {}
+        orphan_procedures = []
+        templates = {'encounters': encounters_template, 'procedures': procedures_template}
+        initargs = (spill_dir, templates, sorted(encounter_classes), age_groups, current_date, readmission_window)
+        for partition, partition_frames in enumerate(iter_partitions(n_partitions, n_workers, initargs)):
+            for name in dimensions:
+                fold_cube(cubes[name], partition_frames[name], dimensions[name])
+            for name in STATE_KEYS:
+                states.setdefault(name, partition_frames[name].iloc[0:0])
+                if len(partition_frames[name]) > 0:
+                    runs[name].append(get_partition_path(spill_dir, name, partition))
+                    write_run(partition_frames[name], runs[name][-1], block_rows)
+            orphan_procedures.append(partition_frames['state_orphan_procedures'])
+
+        frames = {name: combine_cube(cubes[name][0], cubes[name][1:], dimensions[name]) for name in dimensions}
+        frames['state_orphan_procedures'] = combine_frames(orphan_procedures)
+
+        # Each partition's states are sorted on their key, so they are merged as runs into a file outside the spill directory
+        for name, key in STATE_KEYS.items():
+            if runs[name]:
+                frames[name] = merge_run_files(runs[name], key, get_temp_path(os.path.join(CACHE_DIR, f'{name}.arrow')), spill_dir, block_rows, chunk_size)
+            else:
+                frames[name] = states[name]
+
+    return frames, current_date
@@ -0,0 +1,10 @@
+import pytest
+
+from bench import generate_data
+
+@pytest.fixture(scope='session')
+def data_dir(tmp_path_factory):
+    # Generated sources in data/ under a directory that tests run from, as the service does
+    data_dir = tmp_path_factory.mktemp('bench')
+    generate_data(6000, str(data_dir / 'data'), seed=1, chunk_size=2000)
+    return data_dir
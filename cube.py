@@ -0,0 +1,198 @@
+import hashlib
+import json
+import os
+
+import pandas as pd
+import pyarrow.feather as feather
+
+from cache import set_version
+from census import create_cube_census
+from chunked import build_cubes_chunked
+from helper import *
+from incremental import CUBE_DIMENSIONS, STATE_KEYS, apply_batch, combine_cube, combine_frames, create_state, merge_runs, restore_dtypes
+from loader import CACHE_DIR, get_file_hash, get_table_version, get_temp_path, load_table, read_csv
+from profiling import profiled
+
+CUBE_VERSION = 9
+CUBE_NAMES = ['cube_encounters', 'cube_patients', 'cube_procedures', 'cube_census']
+STATE_NAMES = ['state_encounters', 'state_admissions', 'state_patient_months', 'state_orphan_procedures']
+SOURCE_TABLES = ['encounters', 'patients', 'payers', 'procedures']
+META_PATH = os.path.join(CACHE_DIR, 'cube.json')
+
+# Appended runs are compacted once a frame has more of them than this
+MAX_RUNS = 16
+
+def get_cube_path(name, run):
+    return os.path.join(CACHE_DIR, f'{name}-{run}.arrow')
+
+def get_data_version(age_groups:dict, readmission_window=None):
+    # The cubes depend on the source contents, the age group bins and the readmission window, not on when they were built
+    readmission_window = None if readmission_window is None else str(pd.Timedelta(readmission_window))
+    data_version = hashlib.sha256()
+    data_version.update(json.dumps({'version': CUBE_VERSION, 'age_groups': age_groups, 'readmission_window': readmission_window}, sort_keys=True).encode())
+    for table in SOURCE_TABLES:
+        data_version.update(get_table_version(table).encode())
+
+    return data_version.hexdigest()
+
+def get_meta_version(meta):
+    # Appended batches change the cubes without changing the sources, so they are part of the version
+    return hashlib.sha256(''.join([meta['data_version']] + meta['batches']).encode()).hexdigest()
+
+def get_cube_version(age_groups:dict, readmission_window=None):
+    data_version = get_data_version(age_groups, readmission_window)
+    meta = read_meta()
+    if meta.get('data_version') != data_version:
+        return get_meta_version({'data_version': data_version, 'batches': []})
+
+    return get_meta_version(meta)
+
+@profiled
+def build_cubes(age_groups:dict, readmission_window=None):
+    encounters = load_table('encounters', columns=ENCOUNTERS_COLUMNS)
+    patients = load_table('patients', columns=PATIENTS_COLUMNS)
+    payers = load_table('payers', columns=PAYERS_COLUMNS)
+    procedures = load_table('procedures', columns=PROCEDURES_COLUMNS)
+
+    encounters = transform_encounters(encounters)
+    current_date = encounters['START'].max().date()
+
+    df_encounters = create_df_encounters(encounters, patients, payers, procedures, age_groups, current_date, readmission_window)
+    df_procedure_coverage = create_df_procedure_coverage(procedures, df_encounters)
+
+    frames = {
+        'cube_encounters': create_cube_encounters(df_encounters),
+        'cube_patients': create_cube_patients(df_encounters),
+        'cube_procedures': create_cube_procedures(df_procedure_coverage),
+        'cube_census': create_cube_census(encounters)
+    }
+    frames.update(create_state(df_encounters, df_procedure_coverage))
+
+    return frames, current_date
+
+def read_meta():
+    if not os.path.exists(META_PATH):
+        return {}
+
+    with open(META_PATH) as f:
+        return json.load(f)
+
+def save_cubes(frames, meta, is_append=False):
+    # Every write goes to new run files and the meta file is replaced last, so a reader sees either the old runs or the new ones.
+    # An append adds a run to the frames that grow with the history and replaces the others, and any other write replaces them all
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    run = meta.get('next_run', 0)
+    runs = dict(meta.get('runs', {}))
+    superseded = []
+    for name, df in frames.items():
+        # A frame that an out-of-core build streamed to disk comes as the path of its Arrow file
+        if isinstance(df, str):
+            os.replace(df, get_cube_path(name, run))
+        else:
+            temp_path = get_temp_path(get_cube_path(name, run))
+            feather.write_feather(df, temp_path, compression='uncompressed', chunksize=max(len(df), 1))
+            os.replace(temp_path, get_cube_path(name, run))
+        if is_append and (name in CUBE_DIMENSIONS or name in STATE_KEYS):
+            runs[name] = runs[name] + [run]
+        else:
+            superseded += [[name, previous] for previous in runs.get(name, [])]
+            runs[name] = [run]
+
+    stale = meta.get('stale', [])
+    meta = dict(meta, runs=runs, next_run=run + 1, stale=superseded)
+    temp_path = get_temp_path(META_PATH)
+    with open(temp_path, 'w') as f:
+        json.dump(meta, f)
+    os.replace(temp_path, META_PATH)
+
+    # Files are removed one write after they were superseded, so that a reader holding the previous meta can still open them
+    for name, previous in stale:
+        if os.path.exists(get_cube_path(name, previous)):
+            os.remove(get_cube_path(name, previous))
+
+    return meta
+
+def read_runs(name, meta):
+    # Runs are memory-mapped, so reading one only converts what is taken from it
+    return [feather.read_table(get_cube_path(name, run), memory_map=True) for run in meta['runs'][name]]
+
+def read_cubes(names, meta=None):
+    # Cells of a cube can repeat across its runs until they are compacted, which every rollup sums over anyway
+    meta = meta or read_meta()
+    frames = {}
+    for name in names:
+        runs = [table.to_pandas() for table in read_runs(name, meta)]
+        frames[name] = runs[0] if len(runs) == 1 else restore_dtypes(combine_frames(runs), runs[0])
+
+    return frames
+
+def compact_cubes(meta):
+    # Cube cells are added up again and the sorted runs of the states merged, so lookups go back to one binary search per state
+    frames = {}
+    for name in list(CUBE_DIMENSIONS) + list(STATE_KEYS):
+        runs = [table.to_pandas() for table in read_runs(name, meta)]
+        if name in CUBE_DIMENSIONS:
+            frames[name] = combine_cube(runs[0], runs[1:], CUBE_DIMENSIONS[name])
+        else:
+            frames[name] = merge_runs(runs, STATE_KEYS[name])
+
+    return save_cubes(frames, meta)
+
+def set_cube_versions(cubes, meta):
+    # Cached results are keyed by the cube version instead of hashing the cubes
+    version = get_meta_version(meta)
+    for name, cube in cubes.items():
+        set_version(cube, f'{name}@{version}')
+
+    return cubes
+
+def is_cube_valid(meta, data_version):
+    if meta.get('data_version') != data_version or not all(name in meta.get('runs', {}) for name in CUBE_NAMES + STATE_NAMES):
+        return False
+
+    return all(os.path.exists(get_cube_path(name, run)) for name in CUBE_NAMES + STATE_NAMES for run in meta['runs'][name])
+
+def load_cubes(age_groups:dict, readmission_window=None, chunk_size=None, n_workers=1):
+    # With a chunk size the cubes are built out of core, with memory bounded by the chunk size,
+    # and with more than one worker its patient partitions are aggregated in parallel
+    data_version = get_data_version(age_groups, readmission_window)
+    meta = read_meta()
+    if is_cube_valid(meta, data_version):
+        return set_cube_versions(read_cubes(CUBE_NAMES, meta), meta)
+
+    if chunk_size is None and n_workers == 1:
+        frames, current_date = build_cubes(age_groups, readmission_window)
+    else:
+        frames, current_date = build_cubes_chunked(age_groups, readmission_window, chunk_size or 1 << 16, n_workers)
+    # The runs of an earlier build are superseded by this one
+    meta = dict(meta, data_version=data_version, current_date=str(current_date), batches=[])
+    meta = save_cubes(frames, meta)
+
+    return set_cube_versions({name: frames[name] for name in CUBE_NAMES}, meta)
+
+def append_batch(encounters_path, procedures_path, age_groups:dict, readmission_window=None, chunk_size=None, n_workers=1):
+    # Ages stay relative to the date the cubes were built on, so a full rebuild is what moves patients between age groups.
+    # That rebuild takes the chunk size and workers of load_cubes
+    meta = read_meta()
+    if not is_cube_valid(meta, get_data_version(age_groups, readmission_window)):
+        load_cubes(age_groups, readmission_window, chunk_size, n_workers)
+        meta = read_meta()
+
+    batch = get_file_hash(encounters_path) + get_file_hash(procedures_path)
+    if batch in meta['batches']:
+        return
+
+    encounters = read_csv(encounters_path)[ENCOUNTERS_COLUMNS]
+    procedures = read_csv(procedures_path)[PROCEDURES_COLUMNS]
+    patients = load_table('patients', columns=PATIENTS_COLUMNS)
+    payers = load_table('payers', columns=PAYERS_COLUMNS)
+
+    # Only the small frames are read whole, and the states that grow with the history are searched in their runs
+    frames = read_cubes(['cube_patients', 'state_orphan_procedures'], meta)
+    frames.update({name: read_runs(name, meta) for name in STATE_KEYS})
+    frames = apply_batch(frames, encounters, procedures, patients, payers, age_groups, meta['current_date'], readmission_window)
+
+    meta['batches'].append(batch)
+    meta = save_cubes(frames, meta, is_append=True)
+    if max(len(runs) for runs in meta['runs'].values()) > MAX_RUNS:
+        compact_cubes(meta)
@@ -0,0 +1,77 @@
+import numpy as np
+import pandas as pd
+
+from cache import cached
+
+PROCEDURE_MEASURES = ['PROCEDURES', 'BASE_COST_COUNT', 'BASE_COST_SUM']
+ORDERS = ['BASE_COST', 'BASE_COST_SUM', 'PROCEDURES']
+
+@cached
+def create_procedure_index(cube_procedures, by):
+    # Descriptions are laid out contiguously for each key, so a drill-down is a dictionary lookup and a slice,
+    # and its cost depends on the number of descriptions rather than on the number of procedures
+    df_index = cube_procedures.dropna(subset=list(by) + ['DESCRIPTION']).groupby(list(by) + ['DESCRIPTION'], observed=True)[PROCEDURE_MEASURES].sum().reset_index()
+
+    is_key_start = np.ones(len(df_index), dtype=bool)
+    if len(df_index) > 0:
+        is_key_start[1:] = (df_index[by].iloc[1:].to_numpy() != df_index[by].iloc[:-1].to_numpy()).any(axis=1)
+    offsets = np.append(np.flatnonzero(is_key_start), len(df_index))
+    df_keys = df_index.loc[is_key_start, by]
+
+    return {
+        'by': list(by),
+        'keys': {key: i for i, key in enumerate(zip(*[df_keys[column].tolist() for column in by]))},
+        'offsets': offsets,
+        'descriptions': df_index['DESCRIPTION'].astype(str).to_numpy(dtype=object),
+        'measures': {measure: df_index[measure].to_numpy() for measure in PROCEDURE_MEASURES}
+    }
+
+def get_key_rows(procedure_index, key):
+    position = procedure_index['keys'].get(tuple(key))
+    if position is None:
+        return slice(0, 0)
+
+    return slice(procedure_index['offsets'][position], procedure_index['offsets'][position + 1])
+
+def to_frame(procedure_index, rows):
+    df = pd.DataFrame({'DESCRIPTION': procedure_index['descriptions'][rows]})
+    for measure, values in procedure_index['measures'].items():
+        df[measure] = values[rows]
+    df['BASE_COST'] = df['BASE_COST_SUM'] / df['BASE_COST_COUNT']
+
+    return df
+
+def get_top_procedures(procedure_index, key, k=5, order='BASE_COST'):
+    # Only the candidates at or above the k-th largest value are sorted, so ties are broken by description as a full sort would
+    rows = get_key_rows(procedure_index, key)
+    measures = {measure: values[rows] for measure, values in procedure_index['measures'].items()}
+    if order == 'BASE_COST':
+        with np.errstate(divide='ignore', invalid='ignore'):
+            values = measures['BASE_COST_SUM'] / measures['BASE_COST_COUNT']
+    else:
+        values = measures[order].astype(float)
+    values = np.where(np.isnan(values), -np.inf, values)
+
+    candidates = np.arange(len(values))
+    if 0 < k < len(values):
+        threshold = np.partition(values, len(values) - k)[len(values) - k]
+        candidates = np.flatnonzero(values >= threshold)
+
+    df_top = to_frame(procedure_index, np.arange(rows.start, rows.stop)[candidates])
+
+    return df_top.sort_values([order, 'DESCRIPTION'], ascending=[False, True]).head(k).reset_index(drop=True)
+
+def get_index_frame(procedure_index, is_selected=None):
+    # Every key's rows, optionally only the keys a predicate on the key selects
+    keys = [key for key in procedure_index['keys'] if is_selected is None or is_selected(dict(zip(procedure_index['by'], key)))]
+    frames = []
+    for key in keys:
+        df = to_frame(procedure_index, get_key_rows(procedure_index, key))
+        for column, value in reversed(list(zip(procedure_index['by'], key))):
+            df.insert(0, column, value)
+        frames.append(df)
+
+    if not frames:
+        return pd.DataFrame(columns=procedure_index['by'] + ['DESCRIPTION'] + PROCEDURE_MEASURES + ['BASE_COST'])
+
+    return pd.concat(frames, ignore_index=True)
@@ -1,153 +1,210 @@
-import streamlit as st
 import pandas as pd
 import numpy as np
-
+from cache import cached
+from explorer import create_procedure_index, get_index_frame
+from loader import parse_timestamps
+from profiling import profiled
+from readmission import flag_readmissions
+from timeseries import get_day_index, rollup_months
+
+# Columns read from the cached tables, so that loads only project what the builders below select
+ENCOUNTERS_COLUMNS = ['Id', 'START', 'STOP', 'PATIENT', 'ORGANIZATION', 'PAYER', 'ENCOUNTERCLASS', 'TOTAL_CLAIM_COST', 'PAYER_COVERAGE']
+ORGANIZATIONS_COLUMNS = ['Id', 'NAME']
+PATIENTS_COLUMNS = ['Id', 'BIRTHDATE', 'GENDER']
+PAYERS_COLUMNS = ['Id', 'NAME']
+PROCEDURES_COLUMNS = ['ENCOUNTER', 'PATIENT', 'DESCRIPTION', 'BASE_COST']
+
+# Age group bins of the dashboard, here so that the benchmark and tests use them without importing the service
+AGE_GROUPS = {
+    '0 – 14 years': [0, 14],
+    '15 – 24 years': [15, 24],
+    '25 – 54 years': [25, 54],
+    '55 – 64 years': [55, 64],
+    '65 years and over': [65, 999]
+}
+
+# Dimensions of the cubes that every report is rolled up from, where encounters are kept by day so that any grain can be rolled up from them
+ENCOUNTER_DIMENSIONS = ['START_DAY', 'AGE_GROUP', 'ENCOUNTERCLASS', 'IS_COVERED']
+PROCEDURE_DIMENSIONS = ['START_MONTH', 'AGE_GROUP', 'ENCOUNTERCLASS', 'IS_COVERED', 'PAYER', 'DESCRIPTION']
+
+def get_month_index(timestamps):
+    # Months are counted from 1970-01, which keeps the cube key a small integer instead of a string per row
+    return pd.DatetimeIndex(timestamps).tz_localize(None).to_numpy().astype('datetime64[M]').astype(np.int32)
+
+def format_months(months):
+    return list(np.datetime_as_string(np.asarray(months, dtype=np.int64).astype('datetime64[M]'), unit='M'))
+
+def parse_month(month):
+    return int(np.datetime64(month, 'M').astype(np.int64))
+
+@profiled
 def transform_encounters(encounters):
-    encounters['START'] = pd.to_datetime(encounters['START'])
-    encounters['STOP'] = pd.to_datetime(encounters['STOP'])
-    encounters['START_MONTH'] = encounters['START'].dt.strftime('%Y-%m')
+    encounters['START'] = parse_timestamps(encounters['START'])
+    encounters['STOP'] = parse_timestamps(encounters['STOP'])
+
+    # An encounter without a start has no month to be reported in
+    encounters = encounters[encounters['START'].notna()].reset_index(drop=True)
+    encounters['START_DAY'] = get_day_index(encounters['START'])
+    encounters['START_MONTH'] = get_month_index(encounters['START'])
     encounters['STAY_DURATION'] = (encounters['STOP'] - encounters['START']) / pd.Timedelta(hours=1)
 
     return encounters
 
-def create_df_admissions(encounters, patients, age_groups:dict, current_date):
-    df_admissions = pd.merge(
-        encounters[['Id', 'START', 'START_MONTH', 'PATIENT', 'ENCOUNTERCLASS']],
-        patients[['Id', 'BIRTHDATE', 'GENDER']].rename(columns={'Id': 'PATIENT'}),
-        on='PATIENT',
-        how='left'
-    )
+def get_age_groups(ages, age_groups:dict):
+    # Bin every age in one searchsorted pass over the sorted lower bounds of the age groups
+    labels = list(age_groups.keys())
+    bounds = np.array(list(age_groups.values()))
+    order = np.argsort(bounds[:, 0], kind='stable')
+    lower, upper = bounds[order, 0], bounds[order, 1]
 
-    df_admissions['AGE'] = (pd.to_datetime(current_date) - pd.to_datetime(df_admissions['BIRTHDATE'])).apply(lambda x: np.floor(x.days/365.25)).astype(int)
-    df_admissions['AGE_GROUP'] = None
-    for age_group, age_range in age_groups.items():
-        df_admissions['AGE_GROUP'] = np.where(
-            (df_admissions['AGE'] >= age_range[0]) & (df_admissions['AGE'] <= age_range[1]),
-            age_group,
-            df_admissions['AGE_GROUP']
-        )
-
-    df_admissions['IS_ADMISSION'] = np.where(df_admissions['ENCOUNTERCLASS'] == 'inpatient', 1, 0)
-    df_admissions['ADMISSION_ORDER'] = df_admissions.groupby(['PATIENT', 'IS_ADMISSION'])['START'].rank().astype(int)
-    df_admissions['IS_READMISSION'] = np.where((df_admissions['IS_ADMISSION'] == 1) & (df_admissions['ADMISSION_ORDER'] > 1), 1, 0)
-
-    return df_admissions
-
-@st.cache_data
-def get_admissions_grouped(df_admissions):
-    df_admissions_grouped = df_admissions.groupby('START_MONTH').agg(
-        PATIENTS = ('PATIENT', 'nunique'),
-        ADMISSIONS = ('IS_ADMISSION', 'sum'),
-        READMISSIONS = ('IS_READMISSION', 'sum'), 
-    ).reset_index()
+    ages = np.asarray(ages, dtype=float)
+    position = (np.searchsorted(lower, ages, side='right') - 1).clip(0)
+    is_matched = (ages >= lower[position]) & (ages <= upper[position])
+    codes = np.where(is_matched, order[position], -1)
 
-    return df_admissions_grouped
+    return pd.Categorical.from_codes(codes, categories=labels)
 
-@st.cache_data
-def get_readmissions_grouped(df_admissions):
-    df_readmissions_grouped = df_admissions.groupby(['START_MONTH', 'AGE_GROUP']).agg(
+@profiled
+def create_df_encounters(encounters, patients, payers, procedures, age_groups:dict, current_date, readmission_window=None):
+    # Patient attributes are computed once per patient rather than once per encounter
+    df_patients = patients[['Id', 'GENDER']].rename(columns={'Id': 'PATIENT'})
+    df_patients['AGE'] = np.floor((pd.to_datetime(current_date) - pd.to_datetime(patients['BIRTHDATE'])).dt.days / 365.25).astype(int)
+    df_patients['AGE_GROUP'] = get_age_groups(df_patients['AGE'], age_groups)
+
+    df_payers = payers[['Id']].rename(columns={'Id': 'PAYER'})
+    df_payers['IS_COVERED'] = np.where(payers['NAME'] == 'NO_INSURANCE', 0, 1)
+
+    df_procedures = procedures.groupby(['ENCOUNTER', 'PATIENT']).agg(
+        PROCEDURES = ('ENCOUNTER', 'count'),
+        TOTAL_PROCEDURE_COST = ('BASE_COST', 'sum')
+    ).reset_index().rename(columns={'ENCOUNTER': 'Id'})
+
+    df_encounters = encounters[['Id', 'START', 'STOP', 'START_DAY', 'START_MONTH', 'PATIENT', 'PAYER', 'ENCOUNTERCLASS', 'STAY_DURATION', 'TOTAL_CLAIM_COST', 'PAYER_COVERAGE']]
+    df_encounters = df_encounters.merge(df_patients, on='PATIENT', how='left')
+    df_encounters = df_encounters.merge(df_payers, on='PAYER', how='left')
+    df_encounters = df_encounters.merge(df_procedures, on=['Id', 'PATIENT'], how='left')
+
+    df_encounters['IS_COVERED'] = df_encounters['IS_COVERED'].fillna(1).astype(int)
+    df_encounters['PROCEDURES'] = df_encounters['PROCEDURES'].fillna(0).astype(int)
+    df_encounters['TOTAL_PROCEDURE_COST'] = df_encounters['TOTAL_PROCEDURE_COST'].fillna(0)
+
+    df_encounters['IS_ADMISSION'] = np.where(df_encounters['ENCOUNTERCLASS'] == 'inpatient', 1, 0)
+    is_admission = (df_encounters['IS_ADMISSION'] == 1).to_numpy()
+    is_readmission = flag_readmissions(df_encounters[is_admission], readmission_window)
+    df_encounters['IS_READMISSION'] = 0
+    df_encounters.loc[is_admission, 'IS_READMISSION'] = is_readmission
+
+    return df_encounters
+
+@profiled
+def create_cube_encounters(df_encounters):
+    # Only additive measures are stored so that means and rates can be rolled up at any grain
+    cube_encounters = df_encounters.groupby(ENCOUNTER_DIMENSIONS, observed=True, dropna=False).agg(
+        ENCOUNTERS = ('Id', 'size'),
         ADMISSIONS = ('IS_ADMISSION', 'sum'),
         READMISSIONS = ('IS_READMISSION', 'sum'),
+        STAY_DURATION_COUNT = ('STAY_DURATION', 'count'),
+        STAY_DURATION_SUM = ('STAY_DURATION', 'sum'),
+        CLAIM_COST_COUNT = ('TOTAL_CLAIM_COST', 'count'),
+        CLAIM_COST_SUM = ('TOTAL_CLAIM_COST', 'sum'),
+        PROCEDURES = ('PROCEDURES', 'sum'),
+        PROCEDURE_COST = ('TOTAL_PROCEDURE_COST', 'sum')
     ).reset_index()
 
-    df_readmissions_grouped['READMISSION_RATE'] = df_readmissions_grouped['READMISSIONS'] / df_readmissions_grouped['ADMISSIONS']
-    df_readmissions_grouped = df_readmissions_grouped.dropna()
+    return cube_encounters
 
-    return df_readmissions_grouped
+@profiled
+def create_cube_patients(df_encounters):
+    # Distinct patients do not add up across cells, so they are counted once per month
+    cube_patients = df_encounters.groupby('START_MONTH').agg(
+        PATIENTS = ('PATIENT', 'nunique')
+    ).reset_index()
 
-def create_df_length(encounters, patients, age_groups:dict, current_date):
-    df_length = pd.merge(
-    encounters[['Id', 'START', 'STOP', 'START_MONTH', 'PATIENT', 'STAY_DURATION']],
-    patients[['Id', 'BIRTHDATE', 'GENDER']].rename(columns={'Id': 'PATIENT'}),
-    on='PATIENT',
-    how='left'
+    return cube_patients
+
+@profiled
+def create_df_procedure_coverage(procedures, df_encounters):
+    # Payer codes are nullable so that procedures without an encounter do not turn them into floats
+    df_procedure_coverage = pd.merge(
+        procedures[['ENCOUNTER', 'PATIENT', 'DESCRIPTION', 'BASE_COST']].rename(columns={'ENCOUNTER': 'Id'}),
+        df_encounters[['Id', 'PATIENT', 'START', 'START_DAY', 'START_MONTH', 'AGE_GROUP', 'ENCOUNTERCLASS', 'IS_COVERED', 'PAYER']].astype({'PAYER': 'Int64'}),
+        on=['Id', 'PATIENT'],
+        how='left'
     )
 
-    df_length['AGE'] = (pd.to_datetime(current_date) - pd.to_datetime(df_length['BIRTHDATE'])).apply(lambda x: np.floor(x.days/365.25)).astype(int)
-    df_length['AGE_GROUP'] = None
-    for age_group, age_range in age_groups.items():
-        df_length['AGE_GROUP'] = np.where(
-            (df_length['AGE'] >= age_range[0]) & (df_length['AGE'] <= age_range[1]),
-            age_group,
-            df_length['AGE_GROUP']
-        )
-
-    return df_length
-
-@st.cache_data
-def get_length_grouped(df_length):
-    df_length_grouped = df_length.groupby('START_MONTH').agg(
-        AVERAGE_DURATION = ('STAY_DURATION', 'mean')
+    return df_procedure_coverage
+
+@profiled
+def create_cube_procedures(df_procedure_coverage):
+    # Procedures without a matching encounter have no month and never appear in a report
+    cube_procedures = df_procedure_coverage.groupby(PROCEDURE_DIMENSIONS, observed=True, dropna=False).agg(
+        PROCEDURES = ('BASE_COST', 'size'),
+        BASE_COST_COUNT = ('BASE_COST', 'count'),
+        BASE_COST_SUM = ('BASE_COST', 'sum')
     ).reset_index()
+    cube_procedures = cube_procedures[cube_procedures['START_MONTH'].notna()].reset_index(drop=True)
+    cube_procedures = cube_procedures.astype({'START_MONTH': np.int32, 'IS_COVERED': int})
 
-    return df_length_grouped
+    return cube_procedures
 
-@st.cache_data
-def get_length_by_age_group_grouped(df_length):
-    df_length_grouped = df_length.groupby(['START_MONTH', 'AGE_GROUP']).agg(
-        AVERAGE_DURATION = ('STAY_DURATION', 'mean')
-    ).reset_index()
+@cached
+@profiled
+def get_admissions_grouped(cube_encounters, cube_patients):
+    df_admissions_grouped = rollup_months(cube_encounters, [], ['ADMISSIONS', 'READMISSIONS'])
+    df_admissions_grouped = cube_patients.merge(df_admissions_grouped, on='START_MONTH')
 
-    return df_length_grouped
+    return df_admissions_grouped
 
-def get_df_cost(encounters):
-    df_cost = encounters[['Id', 'START', 'START_MONTH', 'ENCOUNTERCLASS', 'TOTAL_CLAIM_COST']]
+@cached
+@profiled
+def get_readmissions_grouped(cube_encounters):
+    df_readmissions_grouped = rollup_months(cube_encounters, ['AGE_GROUP'], ['ADMISSIONS', 'READMISSIONS'])
 
-    return df_cost
+    df_readmissions_grouped['READMISSION_RATE'] = df_readmissions_grouped['READMISSIONS'] / df_readmissions_grouped['ADMISSIONS']
+    df_readmissions_grouped = df_readmissions_grouped.dropna()
 
-@st.cache_data
-def get_cost_grouped(df_cost):
-    df_cost_grouped = df_cost.groupby('START_MONTH').agg(
-        AVERAGE_COST = ('TOTAL_CLAIM_COST', 'mean')
-    ).reset_index()
-    
-    return df_cost_grouped
+    return df_readmissions_grouped
 
-@st.cache_data
-def get_cost_by_encounter_class_grouped(df_cost):
-    df_cost_grouped = df_cost.groupby(['START_MONTH', 'ENCOUNTERCLASS']).agg(
-        AVERAGE_COST = ('TOTAL_CLAIM_COST', 'mean')
-    ).reset_index()
+@cached
+@profiled
+def get_length_grouped(cube_encounters):
+    df_length_grouped = rollup_months(cube_encounters, [], ['STAY_DURATION_COUNT', 'STAY_DURATION_SUM'])
+    df_length_grouped['AVERAGE_DURATION'] = df_length_grouped['STAY_DURATION_SUM'] / df_length_grouped['STAY_DURATION_COUNT']
 
-    return df_cost_grouped
+    return df_length_grouped[['START_MONTH', 'AVERAGE_DURATION']]
 
-def get_df_encounter_coverage(encounters, payers, procedures):
-    df_encounter_coverage = pd.merge(
-        encounters[['Id', 'PATIENT', 'START', 'START_MONTH', 'TOTAL_CLAIM_COST', 'PAYER_COVERAGE', 'PAYER']],
-        payers[['Id', 'NAME']].rename(columns={'Id': 'PAYER'}),
-        on='PAYER',
-        how='left'
-    )
+@cached
+@profiled
+def get_length_by_age_group_grouped(cube_encounters):
+    df_length_grouped = rollup_months(cube_encounters, ['AGE_GROUP'], ['STAY_DURATION_COUNT', 'STAY_DURATION_SUM'])
+    df_length_grouped['AVERAGE_DURATION'] = df_length_grouped['STAY_DURATION_SUM'] / df_length_grouped['STAY_DURATION_COUNT']
 
-    df_encounter_coverage['IS_COVERED'] = np.where(df_encounter_coverage['NAME'] == 'NO_INSURANCE', 0, 1)
+    return df_length_grouped[['START_MONTH', 'AGE_GROUP', 'AVERAGE_DURATION']]
 
-    df_procedures = procedures.groupby(['ENCOUNTER', 'PATIENT']).agg(
-        PROCEDURES = ('ENCOUNTER', 'count'),
-        TOTAL_PROCEDURE_COST = ('BASE_COST', 'sum')
-    ).reset_index()
+@cached
+@profiled
+def get_cost_grouped(cube_encounters):
+    df_cost_grouped = rollup_months(cube_encounters, [], ['CLAIM_COST_COUNT', 'CLAIM_COST_SUM'])
+    df_cost_grouped['AVERAGE_COST'] = df_cost_grouped['CLAIM_COST_SUM'] / df_cost_grouped['CLAIM_COST_COUNT']
 
-    df_encounter_coverage = df_encounter_coverage.merge(
-        df_procedures.rename(columns={'ENCOUNTER': 'Id'}),
-        on=['Id', 'PATIENT'],
-        how='left'
-    )
+    return df_cost_grouped[['START_MONTH', 'AVERAGE_COST']]
 
-    df_encounter_coverage['PROCEDURES'] = df_encounter_coverage['PROCEDURES'].fillna(0).astype(int)
-    df_encounter_coverage['TOTAL_PROCEDURE_COST'] = df_encounter_coverage['TOTAL_PROCEDURE_COST'].fillna(0)
+@cached
+@profiled
+def get_cost_by_encounter_class_grouped(cube_encounters):
+    df_cost_grouped = rollup_months(cube_encounters, ['ENCOUNTERCLASS'], ['CLAIM_COST_COUNT', 'CLAIM_COST_SUM'])
+    df_cost_grouped['AVERAGE_COST'] = df_cost_grouped['CLAIM_COST_SUM'] / df_cost_grouped['CLAIM_COST_COUNT']
 
-    return df_encounter_coverage
+    return df_cost_grouped[['START_MONTH', 'ENCOUNTERCLASS', 'AVERAGE_COST']]
 
-@st.cache_data
-def get_encounter_coverage_grouped(df_encounter_coverage):
-    df_encounter_coverage_grouped = df_encounter_coverage.groupby(['START_MONTH', 'IS_COVERED']).agg(
-        PROCEDURES = ('PROCEDURES', 'sum'),
-        PROCEDURE_COST = ('TOTAL_PROCEDURE_COST', 'sum')
-    ).reset_index()
+@cached
+@profiled
+def get_encounter_coverage_grouped(cube_encounters):
+    df_encounter_coverage_grouped = rollup_months(cube_encounters, ['IS_COVERED'], ['PROCEDURES', 'PROCEDURE_COST'])
 
-    df_encounter_coverage_grouped_temp = df_encounter_coverage.groupby(['START_MONTH']).agg(
-        TOTAL_PROCEDURES = ('PROCEDURES', 'sum'),
-        TOTAL_PROCEDURE_COST = ('TOTAL_PROCEDURE_COST', 'sum')
-    ).reset_index()
+    df_encounter_coverage_grouped_temp = rollup_months(cube_encounters, [], ['PROCEDURES', 'PROCEDURE_COST']).rename(
+        columns={'PROCEDURES': 'TOTAL_PROCEDURES', 'PROCEDURE_COST': 'TOTAL_PROCEDURE_COST'}
+    )
 
     df_encounter_coverage_grouped = df_encounter_coverage_grouped.merge(df_encounter_coverage_grouped_temp, on='START_MONTH')
     df_encounter_coverage_grouped = df_encounter_coverage_grouped[df_encounter_coverage_grouped['IS_COVERED'] == 1]
@@ -156,20 +213,21 @@ def get_encounter_coverage_grouped(df_encounter_coverage):
 
     return df_encounter_coverage_grouped
 
-def create_df_procedure_coverage(procedures, df_encounter_coverage):
-    df_procedure_coverage = pd.merge(
-        procedures[['ENCOUNTER', 'PATIENT', 'DESCRIPTION', 'BASE_COST']].rename(columns={'ENCOUNTER': 'Id'}),
-        df_encounter_coverage[['Id', 'PATIENT', 'START', 'START_MONTH', 'IS_COVERED']],
-        on=['Id', 'PATIENT'],
-        how='left'
-    )
+@cached
+@profiled
+def get_procedure_coverage_grouped(cube_procedures):
+    procedure_index = create_procedure_index(cube_procedures, ['START_MONTH', 'IS_COVERED'])
+    df_procedure_coverage_grouped = get_index_frame(procedure_index, lambda key: key['IS_COVERED'] == 0)
 
-    return df_procedure_coverage
+    return df_procedure_coverage_grouped[['START_MONTH', 'DESCRIPTION', 'BASE_COST']]
 
-@st.cache_data
-def get_procedure_coverage_grouped(df_procedure_coverage):
-    df_procedure_coverage_grouped = df_procedure_coverage[df_procedure_coverage['IS_COVERED'] == 0].groupby(['START_MONTH', 'DESCRIPTION']).agg(
-        BASE_COST = ('BASE_COST', 'mean')
-    ).reset_index()
+def index_by_month(df_grouped):
+    # Each month's rows are split out once so that selecting a report is a dictionary lookup,
+    # and month labels are only formatted here, on the few rows of each output
+    groups = list(df_grouped.groupby('START_MONTH', sort=False))
+    labels = format_months([month for month, _ in groups])
+
+    return {label: df.assign(START_MONTH=label).reset_index(drop=True) for label, (_, df) in zip(labels, groups)}
 
-    return df_procedure_coverage_grouped
\ No newline at end of file
+def select_months(month_index, months):
+    return pd.concat([month_index[month] for month in months if month in month_index], ignore_index=True)
@@ -0,0 +1,166 @@
+import numpy as np
+import pandas as pd
+import pyarrow.compute as pc
+from pandas.api.types import union_categoricals
+
+from census import CENSUS_DIMENSIONS, create_cube_census
+from helper import *
+from readmission import flag_readmissions
+
+# States that grow with the history are kept as runs sorted on a key, a base run and one run per appended batch,
+# so that a batch only reads the rows it looks up and only writes its own run. Cubes are kept as runs of cells the same way
+STATE_KEYS = {'state_encounters': 'Id', 'state_admissions': 'PATIENT', 'state_patient_months': 'START_MONTH'}
+CUBE_DIMENSIONS = {'cube_encounters': ENCOUNTER_DIMENSIONS, 'cube_procedures': PROCEDURE_DIMENSIONS, 'cube_census': CENSUS_DIMENSIONS}
+
+def create_state_encounters(df_encounters):
+    # Procedures of later batches find their encounter's cube cell with a binary search on the key code
+    state_encounters = df_encounters[['Id', 'PATIENT', 'START_MONTH', 'PAYER'] + ENCOUNTER_DIMENSIONS].sort_values('Id', kind='stable', ignore_index=True)
+
+    return state_encounters
+
+def create_state_admissions(df_encounters):
+    # Every admission is kept with its cube cell, so that later batches can flag readmissions against a patient's whole history
+    state_admissions = df_encounters.loc[df_encounters['IS_ADMISSION'] == 1, ['PATIENT', 'START', 'STOP'] + ENCOUNTER_DIMENSIONS]
+    state_admissions = state_admissions.sort_values('PATIENT', kind='stable', ignore_index=True)
+
+    return state_admissions
+
+def create_state_patient_months(df_encounters):
+    state_patient_months = df_encounters[['START_MONTH', 'PATIENT']].drop_duplicates().sort_values(['START_MONTH', 'PATIENT'], ignore_index=True)
+
+    return state_patient_months
+
+def create_state_orphan_procedures(df_procedure_coverage):
+    # Procedures whose encounter has not arrived yet are held back until a later batch brings it
+    df_orphan_procedures = df_procedure_coverage[df_procedure_coverage['START_MONTH'].isna()]
+    state_orphan_procedures = df_orphan_procedures[['Id', 'PATIENT', 'DESCRIPTION', 'BASE_COST']].rename(columns={'Id': 'ENCOUNTER'}).reset_index(drop=True)
+
+    return state_orphan_procedures
+
+def create_state(df_encounters, df_procedure_coverage):
+    return {
+        'state_encounters': create_state_encounters(df_encounters),
+        'state_admissions': create_state_admissions(df_encounters),
+        'state_patient_months': create_state_patient_months(df_encounters),
+        'state_orphan_procedures': create_state_orphan_procedures(df_procedure_coverage)
+    }
+
+def combine_frames(frames):
+    # Categoricals keep their categories when every frame has the same ones, and otherwise get the sorted union,
+    # which is the order a full build gives them
+    df = pd.concat(frames, ignore_index=True)
+    for column in frames[0].columns:
+        if isinstance(frames[0][column].dtype, pd.CategoricalDtype):
+            values = [frame[column].astype('category') for frame in frames]
+            is_same = all(value.cat.categories.equals(values[0].cat.categories) for value in values)
+            df[column] = union_categoricals(values, sort_categories=not is_same)
+
+    return df
+
+def restore_dtypes(df, like):
+    # Missing values in the deltas turn integer columns into floats, so every column but the categoricals gets its dtype back,
+    # unless it really has missing values
+    dtypes = {
+        column: dtype for column, dtype in like.dtypes.items()
+        if not isinstance(dtype, pd.CategoricalDtype) and not (isinstance(dtype, np.dtype) and dtype.kind in 'iub' and df[column].isna().any())
+    }
+
+    return df.astype(dtypes)
+
+def combine_cube(cube, cube_deltas, dimensions):
+    measures = cube.columns.difference(dimensions)
+    cube_combined = combine_frames([cube] + cube_deltas)
+    cube_combined = cube_combined.groupby(dimensions, observed=True, dropna=False)[measures].sum().reset_index()
+    cube_combined = restore_dtypes(cube_combined, cube)
+
+    return cube_combined[cube.columns]
+
+def merge_runs(runs, key):
+    # A stable sort finds the runs that are already sorted and merges them, instead of sorting the rows from scratch
+    return restore_dtypes(combine_frames(runs), runs[0]).sort_values(key, kind='stable', ignore_index=True)
+
+def get_codes(values):
+    return np.unique(pd.Series(values).dropna().to_numpy(dtype=np.int64))
+
+def search_runs(runs, key, values):
+    # Runs are memory-mapped Arrow tables sorted on the key, so the rows for the values are found with two binary searches
+    # each and only those rows are converted, which keeps a lookup proportional to the batch rather than to the history
+    values = get_codes(values)
+    frames = []
+    for run in runs:
+        # A run streamed to disk is split in blocks, which are searched one at a time so keys are read without a copy
+        for block in run.to_batches():
+            # Missing keys sort last, as they do in the runs
+            keys = block.column(key)
+            keys = pc.fill_null(keys, np.iinfo(np.int64).max) if keys.null_count else keys
+            keys = keys.to_numpy()
+            if len(keys) == 0 or len(values) == 0 or keys[0] > values[-1] or keys[-1] < values[0]:
+                continue
+            low, high = np.searchsorted(keys, values, 'left'), np.searchsorted(keys, values, 'right')
+            lengths = high - low
+            rows = np.repeat(low - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+            frames.append(block.take(rows).to_pandas())
+    frames = frames or [runs[0].slice(0, 0).to_pandas()]
+
+    return restore_dtypes(combine_frames(frames), frames[0])
+
+def apply_batch(frames, encounters, procedures, patients, payers, age_groups:dict, current_date, readmission_window=None):
+    # The states in STATE_KEYS come as lists of runs. What is returned for them and for the cubes that grow with the history is
+    # only this batch's run, and the small frames that are recounted, cube_patients and the orphan procedures, are returned whole
+    state_encounters = frames['state_encounters']
+
+    # Encounters that were already ingested are dropped so that a batch delivered twice is not counted twice
+    df_known = search_runs(state_encounters, 'Id', encounters['Id'])
+    encounters = transform_encounters(encounters[~encounters['Id'].isin(df_known['Id'])].reset_index(drop=True))
+
+    # Procedures held back by earlier batches are matched again together with this batch
+    procedures = combine_frames([frames['state_orphan_procedures'], procedures[PROCEDURES_COLUMNS]])
+    is_new = procedures['ENCOUNTER'].isin(encounters['Id'])
+    procedures_new = procedures[is_new].reset_index(drop=True)
+    procedures_old = procedures[~is_new].reset_index(drop=True)
+
+    df_encounters = create_df_encounters(encounters, patients, payers, procedures_new, age_groups, current_date, readmission_window)
+
+    # Readmissions are flagged again over the whole history of every patient in the batch. An admission that arrives late
+    # is flagged against the one before it, and admissions from earlier batches whose flag changes are corrected in their cells
+    is_admission = (df_encounters['IS_ADMISSION'] == 1).to_numpy()
+    df_admissions = df_encounters.loc[is_admission, ['PATIENT', 'START', 'STOP'] + ENCOUNTER_DIMENSIONS]
+    df_history = search_runs(frames['state_admissions'], 'PATIENT', df_admissions['PATIENT'])
+    is_readmission = flag_readmissions(combine_frames([df_history, df_admissions]), readmission_window)
+    is_readmission_old = flag_readmissions(df_history, readmission_window)
+
+    df_encounters.loc[is_admission, 'IS_READMISSION'] = is_readmission[len(df_history):]
+    cube_readmissions_old = df_history[ENCOUNTER_DIMENSIONS].assign(READMISSIONS=is_readmission[:len(df_history)] - is_readmission_old)
+    cube_readmissions_old = cube_readmissions_old[cube_readmissions_old['READMISSIONS'] != 0]
+
+    # Procedures of encounters from earlier batches are added to those encounters' cells
+    df_encounters_old = search_runs(state_encounters, 'Id', procedures_old['ENCOUNTER']).rename(columns={'Id': 'ENCOUNTER'})
+    df_procedures_old = procedures_old.merge(df_encounters_old.astype({'PAYER': 'Int64'}), on=['ENCOUNTER', 'PATIENT'], how='left')
+    is_found = df_procedures_old['START_MONTH'].notna().to_numpy()
+    df_procedure_coverage_old = df_procedures_old.loc[is_found, ['DESCRIPTION', 'BASE_COST', 'START_MONTH', 'PAYER'] + ENCOUNTER_DIMENSIONS].reset_index(drop=True)
+    cube_procedures_old = df_procedure_coverage_old.groupby(ENCOUNTER_DIMENSIONS, observed=True, dropna=False).agg(
+        PROCEDURES = ('BASE_COST', 'size'),
+        PROCEDURE_COST = ('BASE_COST', 'sum')
+    ).reset_index()
+
+    df_procedure_coverage_new = create_df_procedure_coverage(procedures_new, df_encounters)
+    df_procedure_coverage = combine_frames([df_procedure_coverage_new[df_procedure_coverage_old.columns], df_procedure_coverage_old])
+
+    # Distinct patients are recounted only for the months this batch touches, from those months' rows of the runs
+    df_patient_months = create_state_patient_months(df_encounters)
+    df_affected = search_runs(frames['state_patient_months'], 'START_MONTH', df_patient_months['START_MONTH'])
+    is_seen = pd.MultiIndex.from_frame(df_patient_months).isin(pd.MultiIndex.from_frame(df_affected[df_patient_months.columns]))
+    df_affected = pd.concat([df_affected, df_patient_months[~is_seen]], ignore_index=True)
+    cube_patients = frames['cube_patients']
+    cube_patients = pd.concat([cube_patients[~cube_patients['START_MONTH'].isin(df_affected['START_MONTH'])], create_cube_patients(df_affected)])
+
+    return {
+        'cube_encounters': combine_cube(create_cube_encounters(df_encounters), [cube_readmissions_old, cube_procedures_old], ENCOUNTER_DIMENSIONS),
+        'cube_patients': cube_patients.sort_values('START_MONTH').reset_index(drop=True),
+        'cube_procedures': create_cube_procedures(df_procedure_coverage),
+        'cube_census': create_cube_census(encounters),
+        'state_encounters': create_state_encounters(df_encounters),
+        'state_admissions': create_state_admissions(df_encounters),
+        'state_patient_months': df_patient_months[~is_seen].reset_index(drop=True),
+        'state_orphan_procedures': procedures_old.loc[~is_found, ['ENCOUNTER', 'PATIENT', 'DESCRIPTION', 'BASE_COST']].reset_index(drop=True)
+    }
@@ -0,0 +1,158 @@
+import hashlib
+import json
+import os
+import tempfile
+
+import numpy as np
+import pandas as pd
+import pyarrow.feather as feather
+
+from profiling import profiled
+
+DATA_DIR = 'data'
+CACHE_DIR = os.path.join(DATA_DIR, '.cache')
+CACHE_VERSION = 2
+
+TIMESTAMP_COLUMNS = ['START', 'STOP']
+DATE_COLUMNS = ['BIRTHDATE', 'DEATHDATE']
+CATEGORY_COLUMNS = ['ENCOUNTERCLASS', 'GENDER', 'DESCRIPTION']
+KEY_COLUMNS = ['Id', 'PATIENT', 'ORGANIZATION', 'PAYER', 'ENCOUNTER']
+
+SOURCE_HASHES = {}
+
+def encode_keys(keys):
+    # UUID strings are hashed to int64 so that the same key gets the same code in every table
+    codes = pd.util.hash_pandas_object(keys, index=False).to_numpy().view(np.int64)
+    if keys.isna().any():
+        return pd.Series(pd.array(codes, dtype='Int64'), index=keys.index).mask(keys.isna())
+
+    return pd.Series(codes, index=keys.index)
+
+def get_file_hash(path):
+    file_hash = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            file_hash.update(block)
+
+    return file_hash.hexdigest()
+
+def get_temp_path(path):
+    # Every writer gets its own temporary file next to the target, so concurrent writers never move each other's file
+    handle, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=os.path.basename(path) + '.', suffix='.tmp')
+    os.close(handle)
+
+    return temp_path
+
+def get_source_path(table):
+    return os.path.join(DATA_DIR, f'{table}.csv')
+
+def get_cache_paths(table):
+    return os.path.join(CACHE_DIR, f'{table}.arrow'), os.path.join(CACHE_DIR, f'{table}.json')
+
+def parse_timestamps(timestamps):
+    # One bulk parse to UTC, so mixed offsets do not fall back to per-row objects and malformed values become NaT
+    return pd.to_datetime(timestamps, utc=True, format='ISO8601', errors='coerce')
+
+def parse_frame(df):
+    for column in df.columns.intersection(TIMESTAMP_COLUMNS):
+        df[column] = parse_timestamps(df[column])
+    for column in df.columns.intersection(DATE_COLUMNS):
+        df[column] = pd.to_datetime(df[column], format='ISO8601', errors='coerce')
+    for column in df.columns.intersection(CATEGORY_COLUMNS):
+        df[column] = df[column].astype('category')
+    for column in df.columns.intersection(KEY_COLUMNS):
+        df[column] = encode_keys(df[column])
+
+    return df
+
+@profiled
+def read_csv(path):
+    return parse_frame(pd.read_csv(path, dtype={column: 'string' for column in KEY_COLUMNS}))
+
+def iter_csv(path, columns=None, chunk_size=1 << 16):
+    # Each chunk is parsed on its own, and key codes come out the same in every chunk because they are hashes
+    for df in pd.read_csv(path, dtype={column: 'string' for column in KEY_COLUMNS}, usecols=columns, chunksize=chunk_size):
+        yield parse_frame(df)
+
+def count_rows(path):
+    rows = -1 # the header is not a row
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            rows += block.count(b'\n')
+
+    return rows
+
+def read_source(table):
+    return read_csv(get_source_path(table))
+
+def is_cache_valid(table):
+    source_path = get_source_path(table)
+    cache_path, meta_path = get_cache_paths(table)
+    if not (os.path.exists(cache_path) and os.path.exists(meta_path)):
+        return False
+
+    with open(meta_path) as f:
+        meta = json.load(f)
+    if meta.get('version') != CACHE_VERSION:
+        return False
+
+    stat = os.stat(source_path)
+    if meta['mtime'] == stat.st_mtime and meta['size'] == stat.st_size:
+        return True
+
+    # The file was touched but not necessarily changed, so compare contents before rebuilding
+    if meta['size'] != stat.st_size or meta['sha256'] != get_file_hash(source_path):
+        return False
+
+    write_meta(table, meta['sha256'])
+    return True
+
+def write_meta(table, sha256):
+    stat = os.stat(get_source_path(table))
+    _, meta_path = get_cache_paths(table)
+    temp_path = get_temp_path(meta_path)
+    with open(temp_path, 'w') as f:
+        json.dump({'version': CACHE_VERSION, 'mtime': stat.st_mtime, 'size': stat.st_size, 'sha256': sha256}, f)
+    os.replace(temp_path, meta_path)
+
+def build_cache(table):
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    cache_path, _ = get_cache_paths(table)
+    sha256 = get_file_hash(get_source_path(table))
+
+    df = read_source(table)
+    # Uncompressed Arrow IPC so that reads can be memory-mapped without decoding
+    temp_path = get_temp_path(cache_path)
+    feather.write_feather(df, temp_path, compression='uncompressed')
+    os.replace(temp_path, cache_path)
+    write_meta(table, sha256)
+
+@profiled
+def load_table(table, columns=None):
+    if not is_cache_valid(table):
+        build_cache(table)
+
+    cache_path, _ = get_cache_paths(table)
+    df = feather.read_table(cache_path, columns=columns, memory_map=True).to_pandas()
+
+    return df
+
+def get_source_hash(table):
+    # Hashes are remembered per file state, so repeated version checks only stat the source
+    stat = os.stat(get_source_path(table))
+    key = (table, stat.st_mtime, stat.st_size)
+    if key not in SOURCE_HASHES:
+        SOURCE_HASHES[key] = get_file_hash(get_source_path(table))
+
+    return SOURCE_HASHES[key]
+
+def get_table_version(table):
+    # Hashing the source does not need the table cache, so checking a version never parses the CSV
+    if not is_cache_valid(table):
+        return get_source_hash(table)
+
+    _, meta_path = get_cache_paths(table)
+    with open(meta_path) as f:
+        meta = json.load(f)
+
+    return meta['sha256']
@@ -0,0 +1,361 @@
+import argparse
+import json
+import logging
+import os
+import threading
+import urllib.parse
+import urllib.request
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pandas as pd
+
+from cache import get_cache_stats
+from census import CENSUS_DIMENSIONS, get_census_grouped
+from charts import create_charts
+from cube import append_batch as append_cube_batch, get_cube_version, load_cubes
+from explorer import ORDERS, create_procedure_index, get_top_procedures
+from loader import load_table
+from helper import *
+from profiling import format_prometheus, get_records, profiled
+from timeseries import GRAINS, ROLLING_DAYS, format_periods, rollup_periods
+
+READMISSION_WINDOW = None # any later admission counts, e.g. pd.Timedelta(days=30) for 30-day readmissions
+
+# Full rebuilds of the cubes run out of core with a chunk size, and in parallel with more than one worker
+CUBE_WORKERS = int(os.environ.get('CUBE_WORKERS', 1))
+CUBE_CHUNK_SIZE = int(os.environ['CUBE_CHUNK_SIZE']) if os.environ.get('CUBE_CHUNK_SIZE') else None
+
+logger = logging.getLogger('metrics')
+
+# Results are shared by every caller in the process and kept only for the current cube version
+RESULTS = {}
+IN_FLIGHT = {}
+PRERENDERED = set()
+LOCK = threading.Lock()
+
+def coalesce(key, compute):
+    # Concurrent callers asking for the same key wait on one computation instead of each running it
+    with LOCK:
+        if key in RESULTS:
+            return RESULTS[key]
+
+        future = IN_FLIGHT.get(key)
+        is_owner = future is None
+        if is_owner:
+            future = IN_FLIGHT[key] = Future()
+
+    if is_owner:
+        try:
+            result = compute()
+        except Exception as e:
+            future.set_exception(e)
+        else:
+            future.set_result(result)
+            with LOCK:
+                for stale_key in [k for k in RESULTS if k[1] != key[1]]:
+                    del RESULTS[stale_key]
+                RESULTS[key] = result
+        finally:
+            with LOCK:
+                del IN_FLIGHT[key]
+
+    return future.result()
+
+def get_cubes(age_groups:dict=AGE_GROUPS, readmission_window=READMISSION_WINDOW):
+    # A cold build runs once however many results, requests and the prerender thread ask for the cubes together
+    version = get_cube_version(age_groups, readmission_window)
+
+    return coalesce(('cubes', version), lambda: load_cubes(age_groups, readmission_window, CUBE_CHUNK_SIZE, CUBE_WORKERS))
+
+def append_batch(encounters_path, procedures_path):
+    # A batch that finds the cubes out of date rebuilds them with the same chunk size and workers as get_cubes
+    append_cube_batch(encounters_path, procedures_path, AGE_GROUPS, READMISSION_WINDOW, CUBE_CHUNK_SIZE, CUBE_WORKERS)
+
+@profiled
+def create_datasets(age_groups:dict, readmission_window=None):
+    cubes = get_cubes(age_groups, readmission_window)
+    cube_encounters, cube_patients, cube_procedures, cube_census = cubes['cube_encounters'], cubes['cube_patients'], cubes['cube_procedures'], cubes['cube_census']
+
+    return {
+        'months': format_months(sorted(cube_patients['START_MONTH'], reverse=True)[1:]), # assume latest month is incomplete
+        'admissions': index_by_month(get_admissions_grouped(cube_encounters, cube_patients)),
+        'readmissions': index_by_month(get_readmissions_grouped(cube_encounters)),
+        'length': index_by_month(get_length_grouped(cube_encounters)),
+        'length_by_age_group': index_by_month(get_length_by_age_group_grouped(cube_encounters)),
+        'cost': index_by_month(get_cost_grouped(cube_encounters)),
+        'cost_by_encounter_class': index_by_month(get_cost_by_encounter_class_grouped(cube_encounters)),
+        'encounter_coverage': index_by_month(get_encounter_coverage_grouped(cube_encounters)),
+        'procedure_index': create_procedure_index(cube_procedures, ['START_MONTH', 'IS_COVERED']),
+        'census': index_by_month(get_census_grouped(cube_census, [])),
+        'census_by_encounter_class': index_by_month(get_census_grouped(cube_census, ['ENCOUNTERCLASS']))
+    }
+
+@profiled
+def create_report(datasets, selected_month):
+    # The report holds plain values and records, so it is the same whether it is used in process or sent as JSON
+    previous_month = (pd.to_datetime(selected_month) - pd.DateOffset(months=1)).strftime('%Y-%m')
+    df_admissions = datasets['admissions'][selected_month]
+
+    metrics = {
+        'PATIENTS': int(df_admissions['PATIENTS'].item()),
+        'ADMISSIONS': int(df_admissions['ADMISSIONS'].item()),
+        'READMISSION_RATE': float((df_admissions['READMISSIONS'] / df_admissions['ADMISSIONS']).item()),
+        'AVERAGE_DURATION': float(datasets['length'][selected_month]['AVERAGE_DURATION'].item()),
+        'AVERAGE_COST': float(datasets['cost'][selected_month]['AVERAGE_COST'].item()),
+        'PROCEDURES_COVERED': int(datasets['encounter_coverage'][selected_month]['PROCEDURES'].item()),
+        'PEAK_CENSUS': int(datasets['census'][selected_month]['PEAK_CENSUS'].item()),
+        'P95_CENSUS': float(datasets['census'][selected_month]['P95_CENSUS'].item()),
+        'MEAN_CENSUS': float(datasets['census'][selected_month]['MEAN_CENSUS'].item())
+    }
+
+    tabs = {
+        'admissions': select_months(datasets['admissions'], [previous_month, selected_month]),
+        'readmissions': select_months(datasets['readmissions'], [selected_month]).sort_values(['READMISSIONS', 'AGE_GROUP'], ascending=[False, True]),
+        'cost': select_months(datasets['cost'], [previous_month, selected_month]),
+        'cost_by_encounter_class': select_months(datasets['cost_by_encounter_class'], [selected_month]).sort_values(['AVERAGE_COST', 'ENCOUNTERCLASS'], ascending=[False, True]),
+        'length': select_months(datasets['length'], [previous_month, selected_month]),
+        'length_by_age_group': select_months(datasets['length_by_age_group'], [selected_month]).sort_values(['AVERAGE_DURATION', 'AGE_GROUP'], ascending=[False, True]),
+        'encounter_coverage': select_months(datasets['encounter_coverage'], [previous_month, selected_month]),
+        'procedure_coverage': get_top_procedures(datasets['procedure_index'], (parse_month(selected_month), 0), 5).assign(START_MONTH=selected_month)[['START_MONTH', 'DESCRIPTION', 'BASE_COST']],
+        'census_by_encounter_class': select_months(datasets['census_by_encounter_class'], [selected_month]).sort_values(['PEAK_CENSUS', 'ENCOUNTERCLASS'], ascending=[False, True])
+    }
+
+    return {
+        'month': selected_month,
+        'previous_month': previous_month,
+        'metrics': metrics,
+        'tabs': {name: json.loads(df.to_json(orient='records', double_precision=15)) for name, df in tabs.items()}
+    }
+
+def get_datasets(age_groups:dict=AGE_GROUPS, readmission_window=READMISSION_WINDOW):
+    version = get_cube_version(age_groups, readmission_window)
+
+    return coalesce(('datasets', version), lambda: create_datasets(age_groups, readmission_window))
+
+def fetch_json(url):
+    with urllib.request.urlopen(url) as response:
+        return json.load(response)
+
+def get_months(url=None):
+    if url:
+        return fetch_json(f'{url}/months')
+
+    return get_datasets()['months']
+
+def get_report(selected_month, url=None):
+    if url:
+        return fetch_json(f'{url}/report?' + urllib.parse.urlencode({'month': selected_month}))
+
+    version = get_cube_version(AGE_GROUPS, READMISSION_WINDOW)
+
+    return coalesce(('report', version, selected_month), lambda: create_report(get_datasets(), selected_month))
+
+def create_series(grain, start=None, stop=None, by=()):
+    # Encounter measures over any grain and date range, rolled up from the daily cube without regrouping encounters
+    cube_encounters = get_cubes()['cube_encounters']
+    measures = list(cube_encounters.columns.difference(ENCOUNTER_DIMENSIONS))
+    df_series = rollup_periods(cube_encounters, grain, list(by), measures, start, stop)
+
+    # A rolling period is labelled by the day it ends on
+    days = df_series['PERIOD_STOP'] - 1 if grain in ROLLING_DAYS else df_series['PERIOD_START']
+    df_series.insert(0, 'PERIOD', format_periods(days, grain))
+    for column in ['PERIOD_START', 'PERIOD_STOP']:
+        df_series[column] = format_periods(df_series[column], 'day')
+
+    return json.loads(df_series.to_json(orient='records', double_precision=15))
+
+def get_series(grain, start=None, stop=None, by=(), url=None):
+    if url:
+        query = {'grain': grain, 'start': start, 'stop': stop, 'by': ','.join(by)}
+        return fetch_json(f'{url}/series?' + urllib.parse.urlencode({key: value for key, value in query.items() if value}))
+
+    version = get_cube_version(AGE_GROUPS, READMISSION_WINDOW)
+
+    return coalesce(('series', version, grain, start, stop, tuple(by)), lambda: create_series(grain, start, stop, by))
+
+def create_census(by):
+    # Monthly peak, 95th percentile and mean of the hourly census, with organizations named rather than coded
+    cube_census = get_cubes()['cube_census']
+    df_census = get_census_grouped(cube_census, list(by))
+    if 'ORGANIZATION' in by:
+        organizations = load_table('organizations', columns=ORGANIZATIONS_COLUMNS)
+        df_census['ORGANIZATION'] = df_census['ORGANIZATION'].map(organizations.set_index('Id')['NAME'])
+    df_census['START_MONTH'] = format_months(df_census['START_MONTH'])
+
+    return json.loads(df_census.to_json(orient='records', double_precision=15))
+
+def get_census_summary(by=(), url=None):
+    if url:
+        return fetch_json(f'{url}/census?' + urllib.parse.urlencode({'by': ','.join(by)}))
+
+    version = get_cube_version(AGE_GROUPS, READMISSION_WINDOW)
+
+    return coalesce(('census', version, tuple(by)), lambda: create_census(by))
+
+def create_procedures(selected_month, is_covered=None, payer=None, age_group=None, k=5, order='BASE_COST'):
+    # Each combination of filters has its own index, built once per cube version, so drill-downs never scan the procedures
+    cube_procedures = get_cubes()['cube_procedures']
+    filters = {'START_MONTH': parse_month(selected_month), 'IS_COVERED': is_covered, 'AGE_GROUP': age_group}
+    if payer is not None:
+        # An unknown payer has no procedures, rather than dropping the filter and answering for every payer
+        payers = load_table('payers', columns=PAYERS_COLUMNS).set_index('NAME')['Id']
+        if payer not in payers.index:
+            return []
+        filters['PAYER'] = payers[payer]
+    filters = {column: value for column, value in filters.items() if value is not None}
+
+    procedure_index = create_procedure_index(cube_procedures, list(filters))
+    df_procedures = get_top_procedures(procedure_index, tuple(filters.values()), k, order)
+
+    return json.loads(df_procedures.to_json(orient='records', double_precision=15))
+
+def get_payer_names():
+    return set(load_table('payers', columns=PAYERS_COLUMNS)['NAME'])
+
+def get_procedures(selected_month, is_covered=None, payer=None, age_group=None, k=5, order='BASE_COST', url=None):
+    if url:
+        query = {'month': selected_month, 'covered': is_covered, 'payer': payer, 'age_group': age_group, 'k': k, 'order': order}
+        return fetch_json(f'{url}/procedures?' + urllib.parse.urlencode({key: value for key, value in query.items() if value is not None}))
+
+    version = get_cube_version(AGE_GROUPS, READMISSION_WINDOW)
+    key = ('procedures', version, selected_month, is_covered, payer, age_group, k, order)
+
+    return coalesce(key, lambda: create_procedures(selected_month, is_covered, payer, age_group, k, order))
+
+def get_chart_payload(selected_month):
+    # Figures and narrative for a month are built once per cube version and kept as the bytes that are sent
+    version = get_cube_version(AGE_GROUPS, READMISSION_WINDOW)
+
+    return coalesce(('charts', version, selected_month), lambda: json.dumps(create_charts(get_report(selected_month)), separators=(',', ':')).encode())
+
+def get_charts(selected_month, url=None):
+    if url:
+        return fetch_json(f'{url}/charts?' + urllib.parse.urlencode({'month': selected_month}))
+
+    return json.loads(get_chart_payload(selected_month))
+
+def prerender_charts():
+    # Months are rendered newest first, which is the order the dashboard offers them in
+    # A month that fails is logged and skipped, and a request for it gets the error again
+    for selected_month in get_months():
+        try:
+            get_chart_payload(selected_month)
+        except Exception:
+            logger.exception(f'Pre-rendering charts for {selected_month} failed')
+
+def start_prerender():
+    # One background pass per cube version, and a month asked for meanwhile waits on the same computation
+    version = get_cube_version(AGE_GROUPS, READMISSION_WINDOW)
+    with LOCK:
+        if version in PRERENDERED:
+            return
+        PRERENDERED.add(version)
+
+    threading.Thread(target=prerender_charts, daemon=True).start()
+
+def get_profile(url=None):
+    if url:
+        return fetch_json(f'{url}/profile')
+
+    return get_records()
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        # A failure is answered as a JSON error instead of closing the connection without a response
+        try:
+            self.route()
+        except Exception as e:
+            logger.exception(f'GET {self.path} failed')
+            self.send_json(500, {'error': f'{type(e).__name__}: {e}'})
+
+    def route(self):
+        url = urllib.parse.urlparse(self.path)
+        query = urllib.parse.parse_qs(url.query)
+
+        if url.path == '/months':
+            self.send_json(200, get_months())
+        elif url.path == '/cache':
+            self.send_json(200, get_cache_stats())
+        elif url.path == '/series':
+            grain = query.get('grain', ['month'])[0]
+            by = [column for column in query.get('by', [''])[0].split(',') if column]
+            if grain not in GRAINS:
+                self.send_json(400, {'error': f'Unknown grain {grain}, expected one of {GRAINS}'})
+            elif not set(by) <= set(ENCOUNTER_DIMENSIONS[1:]):
+                self.send_json(400, {'error': f'Unknown dimensions {by}, expected some of {ENCOUNTER_DIMENSIONS[1:]}'})
+            else:
+                self.send_json(200, get_series(grain, query.get('start', [None])[0], query.get('stop', [None])[0], by))
+        elif url.path == '/census':
+            by = [column for column in query.get('by', [''])[0].split(',') if column]
+            if not set(by) <= set(CENSUS_DIMENSIONS[:-1]):
+                self.send_json(400, {'error': f'Unknown dimensions {by}, expected some of {CENSUS_DIMENSIONS[:-1]}'})
+            else:
+                self.send_json(200, get_census_summary(by))
+        elif url.path == '/procedures' and query.get('month'):
+            selected_month = query['month'][0]
+            order = query.get('order', ['BASE_COST'])[0]
+            covered = query.get('covered', [None])[0]
+            payer = query.get('payer', [None])[0]
+            age_group = query.get('age_group', [None])[0]
+            k = query.get('k', ['5'])[0]
+            if selected_month not in get_months():
+                self.send_json(404, {'error': f'No procedures for month {selected_month}'})
+            elif order not in ORDERS:
+                self.send_json(400, {'error': f'Unknown order {order}, expected one of {ORDERS}'})
+            elif covered not in [None, '0', '1']:
+                self.send_json(400, {'error': f'Invalid covered {covered}, expected 0 or 1'})
+            elif not k.isdecimal():
+                self.send_json(400, {'error': f'Invalid k {k}, expected a non-negative integer'})
+            elif payer is not None and payer not in get_payer_names():
+                self.send_json(404, {'error': f'Unknown payer {payer}'})
+            else:
+                is_covered = None if covered is None else int(covered)
+                self.send_json(200, get_procedures(selected_month, is_covered, payer, age_group, int(k), order))
+        elif url.path == '/profile':
+            self.send_json(200, get_profile())
+        elif url.path == '/metrics':
+            self.send_text(200, format_prometheus(get_cache_stats()))
+        elif url.path == '/report' and query.get('month'):
+            selected_month = query['month'][0]
+            if selected_month not in get_months():
+                self.send_json(404, {'error': f'No report for month {selected_month}'})
+            else:
+                self.send_json(200, get_report(selected_month))
+        elif url.path == '/charts' and query.get('month'):
+            selected_month = query['month'][0]
+            if selected_month not in get_months():
+                self.send_json(404, {'error': f'No charts for month {selected_month}'})
+            else:
+                self.send_bytes(200, get_chart_payload(selected_month), 'application/json')
+        else:
+            self.send_json(404, {'error': f'Unknown path {url.path}'})
+
+    def send_json(self, status, body):
+        self.send_bytes(status, json.dumps(body).encode(), 'application/json')
+
+    def send_text(self, status, body):
+        self.send_bytes(status, body.encode(), 'text/plain; version=0.0.4')
+
+    def send_bytes(self, status, payload, content_type):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+def serve(host='127.0.0.1', port=8765):
+    start_prerender()
+    with ThreadingHTTPServer((host, port), MetricsHandler) as server:
+        server.serve_forever()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve the dashboard metrics as JSON')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--workers', type=int, default=CUBE_WORKERS, help='worker processes of a full cube rebuild, also CUBE_WORKERS')
+    parser.add_argument('--chunk-size', type=int, default=CUBE_CHUNK_SIZE, help='rows per partition of a full cube rebuild, also CUBE_CHUNK_SIZE')
+    args = parser.parse_args()
+    CUBE_WORKERS, CUBE_CHUNK_SIZE = args.workers, args.chunk_size
+
+    serve(args.host, args.port)
@@ -0,0 +1,120 @@
+import contextlib
+import functools
+import json
+import logging
+import os
+import resource
+import sys
+import threading
+import time
+from collections import deque
+
+import pandas as pd
+
+# Profiling is decided once at import, so with it off the decorated functions are the undecorated ones
+ENABLED = os.environ.get('PIPELINE_PROFILE', '').lower() in ('1', 'true', 'yes')
+MAX_RECORDS = int(os.environ.get('PIPELINE_PROFILE_RECORDS', 1000))
+
+RECORDS = deque(maxlen=MAX_RECORDS)
+TOTALS = {}
+LOCK = threading.Lock()
+
+logger = logging.getLogger('pipeline')
+# Records are info messages, which an unconfigured logger drops, so profiling brings its own handler unless one is set
+if ENABLED and not logger.handlers:
+    logger.addHandler(logging.StreamHandler())
+    logger.setLevel(logging.INFO)
+
+def get_rss():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        # Without /proc only the lifetime peak is available, which is reported in kilobytes on Linux and bytes on macOS
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+
+def count_rows(values):
+    rows = [len(value) for value in values if isinstance(value, (pd.DataFrame, pd.Series))]
+
+    return sum(rows) if rows else None
+
+def record(stage, seconds, rows_in, rows_out, memory_delta):
+    entry = {
+        'stage': stage,
+        'time': time.time(),
+        'seconds': seconds,
+        'rows_in': rows_in,
+        'rows_out': rows_out,
+        'memory_delta_bytes': memory_delta
+    }
+
+    with LOCK:
+        RECORDS.append(entry)
+        totals = TOTALS.setdefault(stage, {'calls': 0, 'seconds': 0.0, 'rows_in': 0, 'rows_out': 0, 'memory_delta_bytes': 0})
+        totals['calls'] += 1
+        totals['seconds'] += seconds
+        totals['rows_in'] += rows_in or 0
+        totals['rows_out'] += rows_out or 0
+        totals['memory_delta_bytes'] += memory_delta
+
+    logger.info(json.dumps(entry))
+
+def profiled(function):
+    if not ENABLED:
+        return function
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        rss = get_rss()
+        start = time.perf_counter()
+        result = function(*args, **kwargs)
+        seconds = time.perf_counter() - start
+        record(function.__name__, seconds, count_rows(list(args) + list(kwargs.values())), count_rows([result]), get_rss() - rss)
+
+        return result
+
+    return wrapper
+
+@contextlib.contextmanager
+def timed(stage, rows_in=None):
+    rss = get_rss()
+    start = time.perf_counter()
+    yield
+    record(stage, time.perf_counter() - start, rows_in, None, get_rss() - rss)
+
+def stage(name, rows_in=None):
+    # Blocks of code that are not functions, such as the dashboard charts, are timed with a with-statement
+    if not ENABLED:
+        return contextlib.nullcontext()
+
+    return timed(name, rows_in)
+
+def get_records():
+    with LOCK:
+        return list(RECORDS)
+
+def get_totals():
+    with LOCK:
+        return {name: dict(totals) for name, totals in TOTALS.items()}
+
+def format_prometheus(cache_stats=None):
+    # Text exposition format, with one series per stage for each running total
+    lines = []
+    totals = get_totals()
+    for measure, kind in [('calls', 'counter'), ('seconds', 'counter'), ('rows_in', 'counter'), ('rows_out', 'counter'), ('memory_delta_bytes', 'gauge')]:
+        name = f'pipeline_stage_{measure}' + ('_total' if kind == 'counter' else '')
+        lines.append(f'# TYPE {name} {kind}')
+        lines.extend(f'{name}{{stage="{stage}"}} {stage_totals[measure]}' for stage, stage_totals in sorted(totals.items()))
+
+    for measure, value in sorted((cache_stats or {}).items()):
+        kind = 'counter' if measure in ('hits', 'misses', 'evictions', 'disk_hits', 'disk_writes', 'disk_evictions') else 'gauge'
+        name = f'result_cache_{measure}' + ('_total' if kind == 'counter' else '')
+        lines.append(f'# TYPE {name} {kind}')
+        lines.append(f'{name} {value}')
+
+    return '\n'.join(lines) + '\n'
+
+def clear_records():
+    with LOCK:
+        RECORDS.clear()
+        TOTALS.clear()
@@ -0,0 +1,38 @@
+import numpy as np
+import pandas as pd
+
+# Timestamps are handled as int64 nanoseconds, where the NaT value marks a missing one
+NO_TIME = np.iinfo(np.int64).min
+
+def get_times(dates):
+    return pd.DatetimeIndex(dates).asi8
+
+def flag_readmissions(admissions, readmission_window=None):
+    # Without a window any later admission is a readmission, otherwise it has to start within the window after the previous discharge
+    patient = admissions['PATIENT'].to_numpy(dtype=np.int64, na_value=0)
+    start = get_times(admissions['START'])
+    stop = get_times(admissions['STOP'])
+
+    # One sort on the integer codes puts each patient's admissions next to each other in time order
+    order = np.lexsort((start, patient))
+    patient, start, stop = patient[order], start[order], stop[order]
+
+    n = len(patient)
+    is_group_start = np.ones(n, dtype=bool)
+    is_group_start[1:] = patient[1:] != patient[:-1]
+    group_start = np.maximum.accumulate(np.where(is_group_start, np.arange(n), 0))
+    first_start = start[group_start]
+
+    if readmission_window is None:
+        is_readmission = start > first_start
+    else:
+        previous_start = np.where(is_group_start, NO_TIME, np.r_[NO_TIME, start][:-1])
+        previous_stop = np.where(is_group_start, NO_TIME, np.r_[NO_TIME, stop][:-1])
+        is_known = (previous_start != NO_TIME) & (previous_stop != NO_TIME)
+        gap = np.where(is_known, start - np.where(is_known, previous_stop, 0), 0)
+        is_readmission = is_known & (start > previous_start) & (gap <= pd.Timedelta(readmission_window).value)
+
+    flags = np.empty(n, dtype=int)
+    flags[order] = is_readmission
+
+    return flags
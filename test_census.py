@@ -0,0 +1,48 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from census import create_cube_census, get_census_grouped
+
+def get_hourly_census_grouped(cube_census, by):
+    # Reference that fills in the census of every hour of every group, from the first event to the last one of any group
+    df_events = cube_census.groupby(by + ['HOUR'], observed=True)['DELTA'].sum().reset_index()
+    hours = np.arange(df_events['HOUR'].min(), df_events['HOUR'].max() + 1)
+    frames = []
+    for key, df_group in (df_events.groupby(by, observed=True) if by else [((), df_events)]):
+        census = np.zeros(len(hours), dtype=np.int64)
+        np.add.at(census, df_group['HOUR'].to_numpy() - hours[0], df_group['DELTA'].to_numpy())
+        df_census = pd.DataFrame({'HOUR': hours, 'CENSUS': census.cumsum()})
+        for column, value in zip(by, key if isinstance(key, tuple) else (key,)):
+            df_census[column] = value
+        frames.append(df_census)
+
+    df_census = pd.concat(frames, ignore_index=True)
+    df_census['START_MONTH'] = df_census['HOUR'].to_numpy().astype('datetime64[h]').astype('datetime64[M]').astype(np.int32)
+    grouped = df_census.groupby(['START_MONTH'] + by)['CENSUS']
+    df_census_grouped = grouped.agg(PEAK_CENSUS='max', MEAN_CENSUS='mean')
+    df_census_grouped['P95_CENSUS'] = grouped.quantile(0.95)
+
+    return df_census_grouped.reset_index()[['START_MONTH'] + by + ['PEAK_CENSUS', 'P95_CENSUS', 'MEAN_CENSUS']]
+
+def create_encounters(seed):
+    # Few stays over more than a year, so groups have months with nothing open and runs that cross month starts
+    rng = np.random.default_rng(seed)
+    n = rng.integers(1, 400)
+    start = np.datetime64('2019-01-01T00') + rng.integers(0, 24 * 400, n).astype('timedelta64[h]') + rng.integers(0, 3600, n).astype('timedelta64[s]')
+    stop = start + rng.exponential(20 * 3600, n).astype('timedelta64[s]')
+
+    return pd.DataFrame({
+        'START': pd.to_datetime(start, utc=True),
+        'STOP': pd.to_datetime(stop, utc=True),
+        'ORGANIZATION': rng.integers(0, 4, n) * 1000 + 7,
+        'ENCOUNTERCLASS': pd.Categorical(rng.choice(['a', 'b', 'c'], n), categories=['a', 'b', 'c'])
+    })
+
+@pytest.mark.parametrize('seed', range(30))
+@pytest.mark.parametrize('by', [[], ['ENCOUNTERCLASS'], ['ORGANIZATION', 'ENCOUNTERCLASS']])
+def test_census_matches_hourly_census(seed, by):
+    cube_census = create_cube_census(create_encounters(seed))
+
+    expected = get_hourly_census_grouped(cube_census, by)
+    pd.testing.assert_frame_equal(get_census_grouped.__wrapped__(cube_census, by), expected, check_dtype=False, check_exact=True)
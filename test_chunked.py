@@ -0,0 +1,45 @@
+import shutil
+
+import pandas as pd
+import pytest
+from pyarrow import feather
+
+import chunked
+from cube import build_cubes, build_cubes_chunked
+from helper import AGE_GROUPS
+
+def read_frame(df):
+    return feather.read_feather(df) if isinstance(df, str) else df
+
+def sort_frame(df):
+    return df.sort_values(list(df.columns), kind='stable', ignore_index=True)
+
+@pytest.mark.parametrize('readmission_window', [None, '30D'])
+@pytest.mark.parametrize('chunk_size, n_workers, fan_in', [(1000, 1, 64), (1000, 1, 2), (3000, 4, 64), (65536, 1, 64), (1000, 4, 3)])
+def test_chunked_matches_in_memory(data_dir, monkeypatch, readmission_window, chunk_size, n_workers, fan_in):
+    monkeypatch.chdir(data_dir)
+    monkeypatch.setattr(chunked, 'FAN_IN', fan_in)
+    # Small blocks and few spill files, so that merges read runs in several blocks and buckets are split into partitions
+    monkeypatch.setattr(chunked, 'MIN_BLOCK_ROWS', 1)
+    monkeypatch.setattr(chunked, 'MAX_SPILL_FILES', 4)
+    expected, expected_date = build_cubes(AGE_GROUPS, readmission_window)
+    frames, current_date = build_cubes_chunked(AGE_GROUPS, readmission_window, chunk_size, n_workers)
+
+    assert current_date == expected_date
+    assert frames.keys() == expected.keys()
+    for name, df in frames.items():
+        df = read_frame(df)
+        if name.startswith('cube_'):
+            pd.testing.assert_frame_equal(df, expected[name], rtol=1e-9)
+        else:
+            pd.testing.assert_frame_equal(sort_frame(df), sort_frame(expected[name]), check_categorical=False)
+
+    for name, key in chunked.STATE_KEYS.items():
+        assert read_frame(frames[name])[key].is_monotonic_increasing
+
+def test_chunked_workers_with_cold_cache(data_dir, monkeypatch):
+    monkeypatch.chdir(data_dir)
+    shutil.rmtree(data_dir / 'data' / '.cache', ignore_errors=True)
+    frames, _ = build_cubes_chunked(AGE_GROUPS, None, 1000, 4)
+
+    assert len(frames['cube_encounters']) > 0
@@ -0,0 +1,65 @@
+import shutil
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from cube import CUBE_NAMES, MAX_RUNS, append_batch, build_cubes, load_cubes, read_meta
+from helper import AGE_GROUPS
+from incremental import CUBE_DIMENSIONS, combine_cube
+
+DIMENSIONS = dict(CUBE_DIMENSIONS, cube_patients=['START_MONTH'])
+
+def get_cells(cube, dimensions):
+    # Appended runs repeat cells, so cubes are compared cell by cell once every run is added up
+    return combine_cube(cube, [], dimensions).sort_values(dimensions, ignore_index=True)
+
+def split_sources(data_dir, work_dir, n_batches, seed):
+    # Half of the encounters and a share of the procedures are in the base, and the rest is spread over batches at random,
+    # so later batches hold earlier admissions of a patient and the encounters of procedures already loaded.
+    # The latest encounter is in the base, so that ages are counted from the same date as the full build
+    rng = np.random.default_rng(seed)
+    encounters = pd.read_csv(data_dir / 'data' / 'encounters.csv', dtype=str)
+    procedures = pd.read_csv(data_dir / 'data' / 'procedures.csv', dtype=str)
+    encounter_batches = np.where(rng.random(len(encounters)) < 0.5, 0, rng.integers(1, n_batches + 1, len(encounters)))
+    encounter_batches[pd.to_datetime(encounters['START'], utc=True).argmax()] = 0
+    procedure_batches = rng.integers(0, n_batches + 1, len(procedures))
+
+    (work_dir / 'data').mkdir()
+    for table in ['patients', 'payers', 'organizations']:
+        shutil.copy(data_dir / 'data' / f'{table}.csv', work_dir / 'data' / f'{table}.csv')
+    encounters[encounter_batches == 0].to_csv(work_dir / 'data' / 'encounters.csv', index=False)
+    procedures[procedure_batches == 0].to_csv(work_dir / 'data' / 'procedures.csv', index=False)
+
+    batches = []
+    for batch in range(1, n_batches + 1):
+        paths = work_dir / f'encounters-{batch}.csv', work_dir / f'procedures-{batch}.csv'
+        encounters[encounter_batches == batch].to_csv(paths[0], index=False)
+        procedures[procedure_batches == batch].to_csv(paths[1], index=False)
+        batches.append(paths)
+
+    return batches
+
+@pytest.mark.parametrize('readmission_window', [None, '30D'])
+@pytest.mark.parametrize('n_batches', [2, 19])
+def test_appended_batches_match_full_build(data_dir, tmp_path, monkeypatch, readmission_window, n_batches):
+    monkeypatch.chdir(data_dir)
+    expected, _ = build_cubes(AGE_GROUPS, readmission_window)
+
+    monkeypatch.chdir(tmp_path)
+    batches = split_sources(data_dir, tmp_path, n_batches, seed=n_batches)
+    load_cubes(AGE_GROUPS, readmission_window)
+    for encounters_path, procedures_path in batches:
+        append_batch(str(encounters_path), str(procedures_path), AGE_GROUPS, readmission_window)
+
+    # A batch that was already appended is skipped
+    meta = read_meta()
+    append_batch(str(batches[0][0]), str(batches[0][1]), AGE_GROUPS, readmission_window)
+    assert read_meta() == meta
+    assert len(meta['batches']) == n_batches
+    # More batches than MAX_RUNS have been compacted
+    assert all(len(runs) <= MAX_RUNS for runs in meta['runs'].values())
+
+    cubes = load_cubes(AGE_GROUPS, readmission_window)
+    for name in CUBE_NAMES:
+        pd.testing.assert_frame_equal(get_cells(cubes[name], DIMENSIONS[name]), get_cells(expected[name], DIMENSIONS[name]), rtol=1e-9)
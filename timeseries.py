@@ -0,0 +1,141 @@
+import numpy as np
+import pandas as pd
+
+from cache import cached
+
+# Grains that a daily cube can be rolled up to, where a rolling grain ends on each day and covers the days before it
+GRAINS = ['day', 'week', 'month', 'quarter', 'rolling_30d']
+ROLLING_DAYS = {'rolling_30d': 30}
+
+def get_day_index(timestamps):
+    # Days are counted from 1970-01-01, the same epoch as the month index
+    return pd.DatetimeIndex(timestamps).tz_localize(None).to_numpy().astype('datetime64[D]').astype(np.int32)
+
+def to_day(date):
+    return int(np.datetime64(pd.Timestamp(date).tz_localize(None).date(), 'D').astype(np.int64))
+
+def get_month_of_day(days):
+    return np.asarray(days, dtype=np.int64).astype('datetime64[D]').astype('datetime64[M]').astype(np.int64)
+
+def get_day_of_month(months):
+    return np.asarray(months, dtype=np.int64).astype('datetime64[M]').astype('datetime64[D]').astype(np.int64)
+
+def get_sort_key(values):
+    # Categories sort in their own order, the same order a groupby puts them in
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        return values.cat.codes.to_numpy(dtype=np.int64)
+
+    return pd.factorize(values, sort=True)[0]
+
+@cached
+def create_time_index(cube, by, measures):
+    # Cells are sorted by group and day, and every measure keeps a running total over that order,
+    # so the sum of a group over any range of days is the difference of two totals found by binary search
+    cube = cube.dropna(subset=by) if by else cube
+    keys = np.array([get_sort_key(cube[column]) for column in by]).reshape(len(by), len(cube))
+    order = np.lexsort([cube['START_DAY'].to_numpy()] + list(keys[::-1]))
+    cube, keys = cube.iloc[order].reset_index(drop=True), keys[:, order]
+
+    if by:
+        is_group_start = np.ones(len(cube), dtype=bool)
+        is_group_start[1:] = (keys[:, 1:] != keys[:, :-1]).any(axis=0)
+        offsets = np.append(np.flatnonzero(is_group_start), len(cube))
+        groups = cube.loc[is_group_start, by].reset_index(drop=True)
+    else:
+        offsets = np.array([0, len(cube)])
+        groups = pd.DataFrame(index=range(1))
+
+    return {
+        'days': cube['START_DAY'].to_numpy(dtype=np.int64),
+        'offsets': offsets,
+        'groups': groups,
+        'totals': {measure: np.append(0, cube[measure].to_numpy().cumsum()) for measure in measures}
+    }
+
+def get_periods(first_day, last_day, grain):
+    # Each period is the half-open range of days [start, stop)
+    if grain in ROLLING_DAYS:
+        stops = np.arange(first_day, last_day + 1) + 1
+        return stops - ROLLING_DAYS[grain], stops
+
+    if grain == 'day':
+        boundaries = np.arange(first_day, last_day + 2)
+    elif grain == 'week':
+        # ISO weeks start on Monday, and 1970-01-01 was a Thursday
+        monday = first_day - (first_day + 3) % 7
+        boundaries = np.arange(monday, last_day + 8, 7)
+    elif grain in ('month', 'quarter'):
+        step = 3 if grain == 'quarter' else 1
+        first_month = get_month_of_day(first_day)
+        first_month -= first_month % step
+        boundaries = get_day_of_month(np.arange(first_month, get_month_of_day(last_day) + step + 1, step))
+    else:
+        raise ValueError(f'Unknown grain {grain}, expected one of {GRAINS}')
+
+    return boundaries[:-1], boundaries[1:]
+
+def sum_periods(time_index, starts, stops):
+    frames = []
+    for group in range(len(time_index['groups'])):
+        offset, end = time_index['offsets'][group], time_index['offsets'][group + 1]
+        days = time_index['days'][offset:end]
+        low = offset + np.searchsorted(days, starts)
+        high = offset + np.searchsorted(days, stops)
+
+        # Periods without any cell for the group are left out, as a groupby over the cells would
+        is_observed = high > low
+        df = pd.DataFrame({'PERIOD_START': starts[is_observed], 'PERIOD_STOP': stops[is_observed]})
+        for column in time_index['groups'].columns:
+            df[column] = time_index['groups'][column].iloc[[group] * int(is_observed.sum())].to_numpy()
+        for measure, totals in time_index['totals'].items():
+            df[measure] = totals[high[is_observed]] - totals[low[is_observed]]
+        frames.append(df)
+
+    df_periods = pd.concat(frames, ignore_index=True)
+    for column in time_index['groups'].columns:
+        df_periods[column] = df_periods[column].astype(time_index['groups'][column].dtype)
+
+    return df_periods
+
+def rollup_periods(cube, grain, by, measures, start=None, stop=None):
+    # Periods at the edges of a date range are cut to the range, and without one the range is every day in the cube
+    by = list(by)
+    time_index = create_time_index(cube, by, list(measures))
+    if len(time_index['days']) == 0:
+        return pd.DataFrame(columns=['PERIOD_START', 'PERIOD_STOP'] + by + list(measures))
+
+    first_day = time_index['days'].min() if start is None else to_day(start)
+    last_day = time_index['days'].max() if stop is None else to_day(stop) - 1
+    starts, stops = get_periods(first_day, last_day, grain)
+    if grain not in ROLLING_DAYS:
+        starts, stops = starts.clip(first_day), stops.clip(max=last_day + 1)
+
+    df_periods = sum_periods(time_index, starts, stops)
+
+    return df_periods.sort_values(['PERIOD_START'] + by, kind='stable').reset_index(drop=True)
+
+def rollup_range(cube, start, stop, by, measures):
+    # A single range is two binary searches per group
+    by = list(by)
+    time_index = create_time_index(cube, by, list(measures))
+
+    return sum_periods(time_index, np.array([to_day(start)]), np.array([to_day(stop)])).drop(columns=['PERIOD_START', 'PERIOD_STOP'])
+
+def rollup_months(cube, by, measures):
+    df_months = rollup_periods(cube, 'month', by, measures)
+    df_months.insert(0, 'START_MONTH', get_month_of_day(df_months['PERIOD_START']).astype(np.int32))
+
+    return df_months.drop(columns=['PERIOD_START', 'PERIOD_STOP'])
+
+def format_periods(days, grain):
+    # Labels are only built for the periods that are returned
+    dates = pd.to_datetime(np.asarray(days, dtype=np.int64), unit='D')
+    if grain == 'week':
+        weeks = dates.isocalendar()
+        return list(weeks['year'].astype(str) + '-W' + weeks['week'].astype(str).str.zfill(2))
+    if grain == 'month':
+        return list(dates.strftime('%Y-%m'))
+    if grain == 'quarter':
+        return list(dates.year.astype(str) + 'Q' + dates.quarter.astype(str))
+
+    return list(dates.strftime('%Y-%m-%d'))